@@ -1,13 +1,20 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.ext.asyncio import AsyncSession
-from datetime import datetime
-from typing import List
+import asyncio
+import orjson
+from hashlib import blake2b
+from fastapi import APIRouter, Depends, Header, HTTPException, Response, status
+from fastapi.responses import StreamingResponse
+from pydantic import TypeAdapter
+from sqlalchemy.orm import sessionmaker
+from typing import AsyncIterator, List, Optional
 
-from app.db.session import get_db
-from app.schemas.ai_recommendation import AIRecommendationResponse
-from app.services.ai_service import AIService
+from app.core.cache import TTLCache
+from app.core.clock import utc_now_iso
+from app.core.config import settings
+from app.db.session import get_session_factory, run_in_session
+from app.schemas.ai_recommendation import AIRecommendationItem, AIRecommendationResponse
+from app.services.ai_service import AIService, RecommendationBatcher, get_ai_service, get_recommendation_batcher
 from app.services.customer import get_customer_by_id
-from app.services.order import get_orders_by_customer
+from app.services.order import get_purchase_history_by_customer
 
 
 router = APIRouter(
@@ -15,71 +22,122 @@ router = APIRouter(
     tags=["AI Recommendations"]
 )
 
+# Cached response bodies (already-serialized JSON) keyed by customer + purchase history digest
+_response_cache = TTLCache(
+    maxsize=settings.recommendation_cache_maxsize,
+    ttl=settings.recommendation_cache_ttl
+)
+_response_adapter = TypeAdapter(AIRecommendationResponse)
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Check whether an If-None-Match header matches the given ETag"""
+    if not if_none_match:
+        return False
+    candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return etag in candidates or "*" in candidates
+
+
+async def _load_purchase_history(customer_id: int, session_factory: sessionmaker) -> List[str]:
+    """Fetch a customer's purchase history, raising 404 if the customer or history is missing"""
+    # Fetch customer and purchase history concurrently; AsyncSession is not
+    # safe for concurrent use, so each query gets its own session
+    customer, purchase_history = await asyncio.gather(
+        run_in_session(session_factory, get_customer_by_id, customer_id),
+        run_in_session(session_factory, get_purchase_history_by_customer, customer_id)
+    )
+    
+    # Verify customer exists
+    if not customer:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Customer not found"
+        )
+    
+    if not purchase_history:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="No purchase history found for this customer"
+        )
+    
+    return purchase_history
+
 
 @router.post("/{customer_id}/recommendations", response_model=AIRecommendationResponse)
 async def get_ai_recommendations_endpoint(
     customer_id: int,
-    db: AsyncSession = Depends(get_db)
+    if_none_match: Optional[str] = Header(default=None),
+    session_factory: sessionmaker = Depends(get_session_factory),
+    batcher: RecommendationBatcher = Depends(get_recommendation_batcher)
 ):
     """
     Get AI-powered product recommendations for a customer
     POST /customers/{id}/recommendations
     """
+    purchase_history = await _load_purchase_history(customer_id, session_factory)
     
-    # Initialize AI service
-    ai_service = AIService()
+    # Serve from cache while purchase history is unchanged
+    cache_key = blake2b(
+        f"{customer_id}:{'|'.join(purchase_history)}".encode(),
+        digest_size=16
+    ).hexdigest()
+    etag = f'"{cache_key}"'
+    cache_headers = {
+        "ETag": etag,
+        "Cache-Control": f"private, max-age={settings.recommendation_cache_ttl}"
+    }
     
-    try:
-        # Verify customer exists
-        customer = await get_customer_by_id(db, customer_id)
-        if not customer:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="Customer not found"
-            )
-        
-        # Get customer's purchase history
-        orders = await get_orders_by_customer(db, customer_id)
-        
-        if not orders:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="No purchase history found for this customer"
-            )
-        
-        # Build purchase history list
-        purchase_history = []
-        for order in orders:
-            product_name = order.product.name if order.product else "Unknown Product"
-            category = order.product.category if order.product else "Unknown Category"
-            purchase_history.append(f"{product_name} (Category: {category})")
-        
-        # Get AI recommendations
-        ai_recommendations = await ai_service.get_recommendations(purchase_history)
-        
-        if not ai_recommendations:
-            raise HTTPException(
-                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-                detail="Unable to generate recommendations at this time. AI service may be unavailable."
-            )
-        
-        # Format response
-        response = AIRecommendationResponse(
-            customer_id=customer_id,
-            recommendations=ai_recommendations,
-            total_recommendations=len(ai_recommendations),
-            source="ai",
-            generated_at=datetime.utcnow().isoformat()
-        )
-        
-        return response
-        
-    except HTTPException:
-        # Re-raise HTTP exceptions
-        raise
-    except Exception as e:
-        # Handle unexpected errors
+    cached_body = _response_cache.get(cache_key)
+    if cached_body is not None:
+        if _etag_matches(if_none_match, etag):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=cache_headers)
+        return Response(content=cached_body, media_type="application/json", headers=cache_headers)
+    
+    # Get AI recommendations, batched with concurrent requests
+    ai_recommendations, from_llm = await batcher.submit(purchase_history)
+    
+    if not ai_recommendations:
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Error generating AI recommendations: {str(e)}"
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Unable to generate recommendations at this time. AI service may be unavailable."
         )
+    
+    # Format response; items were type-normalized by the service, so skip re-validation
+    recommendation_response = AIRecommendationResponse.model_construct(
+        customer_id=customer_id,
+        recommendations=[AIRecommendationItem.model_construct(**rec) for rec in ai_recommendations],
+        total_recommendations=len(ai_recommendations),
+        source="ai" if from_llm else "fallback",
+        generated_at=utc_now_iso()
+    )
+    
+    # Serialize once; cache hits then send these bytes without touching pydantic
+    body = _response_adapter.dump_json(recommendation_response)
+    
+    # Only LLM output is cached and validated by ETag; a fallback after a transient
+    # LLM error must not be pinned for the cache TTL
+    if not from_llm:
+        return Response(content=body, media_type="application/json", headers={"Cache-Control": "no-store"})
+    
+    _response_cache.set(cache_key, body)
+    return Response(content=body, media_type="application/json", headers=cache_headers)
+
+
+@router.post("/{customer_id}/recommendations/stream")
+async def stream_ai_recommendations_endpoint(
+    customer_id: int,
+    session_factory: sessionmaker = Depends(get_session_factory),
+    ai_service: AIService = Depends(get_ai_service)
+):
+    """
+    Stream AI-powered recommendations as newline-delimited JSON
+    POST /customers/{id}/recommendations/stream
+    """
+    purchase_history = await _load_purchase_history(customer_id, session_factory)
+    
+    async def ndjson_lines() -> AsyncIterator[bytes]:
+        # Each recommendation is flushed as soon as the model finishes it
+        async for recommendation in ai_service.stream_recommendations(purchase_history):
+            yield orjson.dumps(recommendation) + b"\n"
+    
+    return StreamingResponse(ndjson_lines(), media_type="application/x-ndjson")
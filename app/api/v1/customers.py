@@ -1,15 +1,23 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from pydantic import TypeAdapter
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+from typing import List, Optional
 
-from app.db.session import get_db
+from app.api.v1.ndjson import ndjson_response
+from app.db.session import get_db, get_session_factory
 from app.schemas.customer import CustomerCreate, CustomerRead, CustomerWithHistory
-from app.services.customer import create_customer, get_customer_by_id, get_customer_with_history
+from app.schemas.order import OrderRead
+from app.services.customer import create_customer, get_all_customers, get_customer_by_id, get_customer_with_history
+from app.services.order import get_orders_by_customer
 
 router = APIRouter(
     prefix="/customers",
     tags=["customers"]
 )
 
+_customer_adapter = TypeAdapter(CustomerRead)
+
 
 @router.post("/", response_model=CustomerRead, status_code=status.HTTP_201_CREATED)
 async def create_customer_endpoint(
@@ -17,14 +25,16 @@ async def create_customer_endpoint(
     db: AsyncSession = Depends(get_db)
 ):
     """Create a new customer"""
-    try:
-        customer = await create_customer(db, customer_data)
-        return customer
-    except Exception as e:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Error creating customer: {str(e)}"
-        )
+    customer = await create_customer(db, customer_data)
+    return customer
+
+
+@router.get("/")
+async def list_customers_endpoint(
+    session_factory: sessionmaker = Depends(get_session_factory)
+):
+    """Stream all customers as newline-delimited JSON"""
+    return ndjson_response(session_factory, get_all_customers, _customer_adapter, CustomerRead)
 
 
 @router.get("/{customer_id}/history", response_model=CustomerWithHistory)
@@ -42,3 +52,23 @@ async def get_customer_history_endpoint(
         )
     
     return customer_with_history
+
+
+@router.get("/{customer_id}/orders", response_model=List[OrderRead])
+async def get_customer_orders_endpoint(
+    customer_id: int,
+    limit: int = Query(default=100, ge=1, le=500),
+    after_id: Optional[int] = Query(default=None, description="Return orders with ids after this cursor"),
+    db: AsyncSession = Depends(get_db)
+):
+    """Get a page of a customer's orders; pass the last id seen as after_id for the next page"""
+    orders = await get_orders_by_customer(db, customer_id, limit=limit, after_id=after_id)
+    
+    # Only an empty first page pays for the lookup that tells "no orders" from "no customer"
+    if not orders and after_id is None and not await get_customer_by_id(db, customer_id):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Customer not found"
+        )
+    
+    return orders
@@ -0,0 +1,21 @@
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, TypeAdapter
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+from typing import Any, AsyncIterator, Callable, Type
+
+
+def ndjson_response(
+    session_factory: sessionmaker,
+    stream_fn: Callable[[AsyncSession], AsyncIterator[Any]],
+    adapter: TypeAdapter,
+    schema: Type[BaseModel]
+) -> StreamingResponse:
+    """Stream every row yielded by stream_fn as newline-delimited JSON"""
+    async def ndjson_lines() -> AsyncIterator[bytes]:
+        # The stream owns its session so rows can be fetched while the body is sent
+        async with session_factory() as db:
+            async for row in stream_fn(db):
+                yield adapter.dump_json(schema.model_validate(row)) + b"\n"
+    
+    return StreamingResponse(ndjson_lines(), media_type="application/x-ndjson")
@@ -1,17 +1,23 @@
 from fastapi import APIRouter, Depends, HTTPException, status
+from pydantic import TypeAdapter
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
 
-from app.db.session import get_db
+from app.api.v1.ndjson import ndjson_response
+from app.db.session import get_db, get_session_factory
 from app.schemas.order import OrderCreate, OrderRead
-from app.services.order import create_order, get_order_by_id
+from app.services.order import create_order, get_all_orders, get_order_by_id
 from app.services.customer import get_customer_by_id
-from app.services.product import get_product_by_id
+from app.services.recommendation import invalidate_customer_context
 
 router = APIRouter(
     prefix="/orders",
     tags=["orders"]
 )
 
+_order_adapter = TypeAdapter(OrderRead)
+
 
 @router.post("/", response_model=OrderRead, status_code=status.HTTP_201_CREATED)
 async def create_order_endpoint(
@@ -19,30 +25,28 @@ async def create_order_endpoint(
     db: AsyncSession = Depends(get_db)
 ):
     """Create a new order"""
-    # Validate customer exists
-    customer = await get_customer_by_id(db, order_data.customer_id)
-    if not customer:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Customer not found"
-        )
-    
-    # Validate product exists
-    product = await get_product_by_id(db, order_data.product_id)
-    if not product:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Product not found"
-        )
-    
+    # Foreign keys validate customer and product as part of the insert
     try:
         order = await create_order(db, order_data)
-        return order
-    except Exception as e:
+    except IntegrityError:
+        await db.rollback()
+        # Only the failure path pays for a lookup to report which reference is missing
+        customer = await get_customer_by_id(db, order_data.customer_id)
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Error creating order: {str(e)}"
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Product not found" if customer else "Customer not found"
         )
+    
+    invalidate_customer_context(order.customer_id)
+    return order
+
+
+@router.get("/")
+async def list_orders_endpoint(
+    session_factory: sessionmaker = Depends(get_session_factory)
+):
+    """Stream all orders as newline-delimited JSON"""
+    return ndjson_response(session_factory, get_all_orders, _order_adapter, OrderRead)
 
 
 @router.get("/{order_id}", response_model=OrderRead)
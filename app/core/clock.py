@@ -0,0 +1,18 @@
+import time
+from datetime import datetime, timezone
+
+
+# (epoch second, formatted timestamp) for the most recent call
+_cached_timestamp = (-1, "")
+
+
+def utc_now_iso() -> str:
+    """Return the current UTC time in ISO format, formatting at most once per second"""
+    global _cached_timestamp
+    
+    now = int(time.time())
+    if now != _cached_timestamp[0]:
+        formatted = datetime.fromtimestamp(now, tz=timezone.utc).replace(tzinfo=None).isoformat()
+        _cached_timestamp = (now, formatted)
+    
+    return _cached_timestamp[1]
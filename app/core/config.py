@@ -1,4 +1,4 @@
-from pydantic_settings import BaseSettings
+from pydantic_settings import BaseSettings, SettingsConfigDict
 from typing import Optional
 
 
@@ -7,16 +7,35 @@ class Settings(BaseSettings):
     
     # Database configuration
     database_url: str = "sqlite+aiosqlite:///./app.db"
+    db_pool_size: int = 20  # Ignored for SQLite
+    db_max_overflow: int = 10
+    db_pool_recycle: int = 3600  # seconds
     
     # LLM configuration
     llm_api_key: Optional[str] = None
     llm_base_url: Optional[str] = None
     llm_model: Optional[str] = None
+    llm_batch_window_ms: int = 20  # Coalescing window for concurrent LLM requests (0 disables)
+    llm_batch_max_size: int = 8
+    llm_max_concurrency: int = 16  # In-flight LLM calls per process before callers queue
+    llm_prewarm_connections: int = 4  # Keep-alive connections opened at startup (0 disables)
     
-    class Config:
-        env_file = ".env"
-        env_file_encoding = "utf-8"
-        case_sensitive = False
+    # Response cache configuration
+    recommendation_cache_ttl: int = 300  # seconds
+    recommendation_cache_maxsize: int = 10_000
+    product_cache_ttl: int = 60  # seconds
+    product_cache_maxsize: int = 4096
+    context_cache_ttl: int = 60  # seconds
+    llm_cache_ttl: int = 300  # seconds
+    
+    # Logging configuration
+    log_level: str = "INFO"
+    
+    model_config = SettingsConfigDict(
+        env_file=".env",
+        env_file_encoding="utf-8",
+        case_sensitive=False
+    )
 
 
 # Create global settings instance
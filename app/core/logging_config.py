@@ -0,0 +1,32 @@
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+
+LOG_FORMAT = "%(asctime)s %(levelname)s [%(name)s] %(message)s"
+
+
+def setup_logging(level: str = "INFO") -> QueueListener:
+    """Route root logging through a queue so records are written off the event loop"""
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    
+    root = logging.getLogger()
+    root.addHandler(QueueHandler(log_queue))
+    root.setLevel(level.upper())
+    
+    # The listener thread does the actual (blocking) I/O
+    listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def shutdown_logging(listener: QueueListener) -> None:
+    """Flush pending records and detach the queue handler"""
+    listener.stop()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if isinstance(handler, QueueHandler) and handler.queue is listener.queue:
+            root.removeHandler(handler)
@@ -1,16 +1,41 @@
+from sqlalchemy import event
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
-from typing import AsyncGenerator
+from typing import Any, AsyncGenerator, Awaitable, Callable
 from app.core.config import settings
 
 
+is_sqlite = settings.database_url.startswith("sqlite")
+
+# Size the connection pool for server databases; SQLite uses SQLAlchemy's defaults
+pool_options = {} if is_sqlite else {
+    "pool_size": settings.db_pool_size,
+    "max_overflow": settings.db_max_overflow,
+    "pool_recycle": settings.db_pool_recycle,
+    "pool_pre_ping": True
+}
+
 # Create async engine
 engine = create_async_engine(
     settings.database_url,
     echo=False,  # Set to True for SQL logging
-    future=True
+    future=True,
+    **pool_options
 )
 
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Enable WAL so concurrent readers are not blocked by writers, and enforce foreign keys"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+
+if is_sqlite:
+    event.listen(engine.sync_engine, "connect", set_sqlite_pragmas)
+
 # Create async session factory
 AsyncSessionLocal = sessionmaker(
     engine,
@@ -26,3 +51,19 @@ async def get_db() -> AsyncGenerator[AsyncSession, None]:
             yield session
         finally:
             await session.close()
+
+
+async def get_session_factory() -> sessionmaker:
+    """Dependency to provide the session factory for concurrent queries"""
+    return AsyncSessionLocal
+
+
+async def run_in_session(
+    session_factory: sessionmaker,
+    query: Callable[..., Awaitable[Any]],
+    *args: Any,
+    **kwargs: Any
+) -> Any:
+    """Run a query on its own session so it can be awaited concurrently with others"""
+    async with session_factory() as session:
+        return await query(session, *args, **kwargs)
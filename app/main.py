@@ -1,24 +1,66 @@
-from fastapi import FastAPI
+import asyncio
+import logging
+from fastapi import FastAPI, Request, Response, status
+from fastapi.responses import JSONResponse
 from contextlib import asynccontextmanager
+from sqlalchemy.exc import SQLAlchemyError
+from app.core.config import settings
+from app.core.logging_config import setup_logging, shutdown_logging
 from app.db.session import engine
 from app.db.base import Base
 from app.api.v1.customers import router as customers_router
 from app.api.v1.orders import router as orders_router
 from app.api.v1.recommendations import router as recommendations_router
 from app.api.v1.ai_recommendations import router as ai_recommendations_router
+from app.services.ai_service import (
+    get_ai_service,
+    get_llm_http_client,
+    get_openai_client,
+    get_recommendation_batcher,
+    prewarm_llm_connections,
+)
+from app.services.recommendation import get_recommendation_service
+
+
+logger = logging.getLogger(__name__)
+
+_HEALTH_BODY = b'{"status":"ok"}'
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Application lifespan events"""
+    # Startup: Move log output onto a background listener thread
+    log_listener = setup_logging(settings.log_level)
+    
     # Startup: Create database tables
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
     
+    # Startup: Pre-warm LLM connections in the background so boot never waits on the LLM
+    prewarm_task = None
+    if settings.llm_prewarm_connections > 0 and get_recommendation_service().is_configured():
+        prewarm_task = asyncio.create_task(prewarm_llm_connections(settings.llm_prewarm_connections))
+    
     yield
     
+    if prewarm_task is not None and not prewarm_task.done():
+        prewarm_task.cancel()
+    
+    # Shutdown: Close the shared LLM HTTP pool (only if it was ever created)
+    if get_llm_http_client.cache_info().currsize:
+        await get_llm_http_client().aclose()
+        get_llm_http_client.cache_clear()
+    get_openai_client.cache_clear()
+    get_ai_service.cache_clear()
+    get_recommendation_batcher.cache_clear()
+    get_recommendation_service.cache_clear()
+    
     # Shutdown: Close database connection
     await engine.dispose()
+    
+    # Shutdown: Flush queued log records
+    shutdown_logging(log_listener)
 
 
 # Create FastAPI app with lifespan
@@ -30,10 +72,31 @@ app = FastAPI(
 )
 
 
+@app.exception_handler(SQLAlchemyError)
+async def database_exception_handler(request: Request, exc: SQLAlchemyError):
+    """Handle database errors without leaking SQL details to clients"""
+    logger.error(f"Database error on {request.method} {request.url.path}: {exc}", exc_info=exc)
+    return JSONResponse(
+        status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+        content={"detail": "Database error"}
+    )
+
+
+@app.exception_handler(Exception)
+async def unhandled_exception_handler(request: Request, exc: Exception):
+    """Handle unexpected errors with a generic response"""
+    logger.error(f"Unhandled error on {request.method} {request.url.path}: {exc}", exc_info=exc)
+    return JSONResponse(
+        status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+        content={"detail": "Internal server error"}
+    )
+
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
-    return {"status": "ok"}
+    # Constant body, so skip per-request serialization entirely
+    return Response(content=_HEALTH_BODY, media_type="application/json")
 
 
 # Register API routers
@@ -44,5 +107,17 @@ app.include_router(ai_recommendations_router)
 
 
 if __name__ == "__main__":
+    import os
     import uvicorn
-    uvicorn.run("app.main:app", host="0.0.0.0", port=8000, reload=True)
+    
+    # WEB_CONCURRENCY is uvicorn's own worker-count variable; reload only works with one worker
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    uvicorn.run(
+        "app.main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        workers=workers,
+        reload=workers == 1
+    )
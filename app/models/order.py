@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, DateTime, ForeignKey, Index
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from app.db.base import Base
@@ -8,10 +8,19 @@ class Order(Base):
     """Order model"""
     
     __tablename__ = "orders"
+    __table_args__ = (
+        # Leading customer_id also serves per-customer lookups on its own
+        Index("ix_orders_customer_product", "customer_id", "product_id"),
+        # Serves keyset pagination of a customer's orders (WHERE customer_id = ? AND id > ? ORDER BY id)
+        Index("ix_orders_customer_id_id", "customer_id", "id"),
+        # Serves a customer's most recent purchases (ORDER BY purchase_date DESC LIMIT n) by
+        # walking the index backwards instead of sorting; product_id and category are indexed already
+        Index("ix_orders_customer_purchase_date", "customer_id", "purchase_date"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     customer_id = Column(Integer, ForeignKey("customers.id"), nullable=False)
-    product_id = Column(Integer, ForeignKey("products.id"), nullable=False)
+    product_id = Column(Integer, ForeignKey("products.id"), nullable=False, index=True)
     quantity = Column(Integer, nullable=False)
     purchase_date = Column(DateTime, default=datetime.utcnow)
     
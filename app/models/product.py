@@ -10,7 +10,7 @@ class Product(Base):
     
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String(200), nullable=False)
-    category = Column(String(100), nullable=False)
+    category = Column(String(100), nullable=False, index=True)
     price = Column(Float, nullable=False)
     description = Column(Text, nullable=True)
     
@@ -1,10 +1,12 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 from typing import List, Dict, Any, Optional
 
 
 class AIRecommendationItem(BaseModel):
     """Schema for a single AI recommendation item"""
     
+    model_config = ConfigDict(frozen=True)
+    
     item: str
     reason: str
     confidence: int  # 0-100
@@ -13,6 +15,8 @@ class AIRecommendationItem(BaseModel):
 class AIRecommendationResponse(BaseModel):
     """Schema for AI recommendation response"""
     
+    model_config = ConfigDict(frozen=True)
+    
     customer_id: int
     recommendations: List[AIRecommendationItem]
     total_recommendations: int
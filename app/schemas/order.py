@@ -1,4 +1,4 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 from typing import Optional
 from datetime import datetime
 from .product import ProductRead
@@ -24,5 +24,4 @@ class OrderRead(BaseModel):
     # Nested product details
     product: Optional[ProductRead] = None
     
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True, frozen=True)
@@ -1,4 +1,4 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 from typing import List, Optional
 from decimal import Decimal
 
@@ -6,6 +6,8 @@ from decimal import Decimal
 class RecommendationItem(BaseModel):
     """Schema for a single product recommendation"""
     
+    model_config = ConfigDict(frozen=True)
+    
     product_id: int
     product_name: str
     category: str
@@ -18,6 +20,8 @@ class RecommendationItem(BaseModel):
 class RecommendationResponse(BaseModel):
     """Schema for recommendation response"""
     
+    model_config = ConfigDict(frozen=True)
+    
     customer_id: int
     recommendations: List[RecommendationItem]
     total_recommendations: int
@@ -27,6 +31,8 @@ class RecommendationResponse(BaseModel):
 class RecommendationContext(BaseModel):
     """Schema for recommendation context/debugging"""
     
+    model_config = ConfigDict(frozen=True)
+    
     customer_name: str
     total_orders: int
     total_spent: Decimal
@@ -1,27 +1,354 @@
-import json
+import asyncio
 import logging
-from typing import List, Dict, Any, Optional
-from openai import AsyncOpenAI
+import re
+import httpx
+import orjson
+from functools import lru_cache
+from types import MappingProxyType
+from typing import List, Dict, Any, AsyncIterator, Mapping, Optional, Set, Tuple
+from fastapi import Depends
+from openai import AsyncOpenAI, BadRequestError
 
 from app.core.config import settings
 
 # Set up logging
 logger = logging.getLogger(__name__)
 
+# Connection pool for the LLM API: keep connections warm, fail fast on connect
+_HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=50)
+_HTTP_TIMEOUT = httpx.Timeout(60.0, connect=5.0)
 
-class AIService:
-    """AI service for generating recommendations using OpenAI-compatible API"""
+# The SDK retries 429/5xx/connection errors with jittered exponential backoff and
+# honours Retry-After; allow a few more attempts than its default of 2
+_MAX_RETRIES = 4
+
+# Bound once to skip the attribute lookup on the hot parse path
+_json_loads = orjson.loads
+
+
+def _extract_json_payload(content: str) -> str:
+    """Slice the body of the first markdown code fence, or return content unchanged"""
+    start = content.find("```")
+    if start < 0:
+        return content
+    
+    start += 3
+    if content.startswith("json", start):
+        start += 4
+    end = content.find("```", start)
+    if end < 0:
+        return content
+    
+    return content[start:end]
+
+
+def _format_history(purchase_history: List[str]) -> str:
+    """Render a purchase history as the bulleted text used by prompts and fallback matching"""
+    return "\n".join(f"- {item}" for item in purchase_history)
+
+
+# Tokens that change JSON nesting state: escapes, quotes, braces and brackets
+_JSON_TOKEN_RE = re.compile(r'\\.?|[{}\[\]"]', re.S)
+
+
+class _IncrementalObjectParser:
+    """Pull JSON objects that are array elements out of streamed text as soon as they close"""
     
     def __init__(self):
-        self.client = AsyncOpenAI(
-            api_key=settings.llm_api_key,
-            base_url=settings.llm_base_url
+        self._parts: List[str] = []
+        self._containers: List[str] = []  # Open brackets/braces outside the object being captured
+        self._depth = 0  # Brace depth inside the object being captured
+        self._in_string = False
+        self._escape_pending = False
+    
+    def feed(self, text: str) -> List[Any]:
+        """Consume the next chunk and return any objects it completed"""
+        objects = []
+        offset = 0
+        if self._escape_pending:
+            # The previous chunk ended with a backslash; its escaped character is this one
+            self._escape_pending = False
+            offset = 1
+        start = 0 if self._depth else None
+        
+        for match in _JSON_TOKEN_RE.finditer(text, offset):
+            token = match.group()
+            if token[0] == "\\":
+                self._escape_pending = len(token) == 1
+                continue
+            if self._in_string:
+                self._in_string = token != '"'
+                continue
+            if token == '"':
+                self._in_string = True
+                continue
+            
+            if not self._depth:
+                # Outside a captured item: track containers so wrappers like
+                # {"recommendations": [...]} are walked through, not captured
+                if token == "{" and self._containers[-1:] == ["["]:
+                    self._depth = 1
+                    start = match.start()
+                elif token in "{[":
+                    self._containers.append(token)
+                elif self._containers:
+                    self._containers.pop()
+                continue
+            
+            if token == "{":
+                self._depth += 1
+            elif token == "}":
+                self._depth -= 1
+                if not self._depth:
+                    self._parts.append(text[start:match.end()])
+                    try:
+                        objects.append(_json_loads("".join(self._parts)))
+                    except orjson.JSONDecodeError:
+                        pass
+                    self._parts = []
+                    start = None
+        
+        if self._depth:
+            self._parts.append(text[start:])
+        return objects
+
+
+# Static prompt parts are built once; only the purchase histories vary per call
+_SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": """You are a helpful shopping assistant specialized in e-commerce recommendations.
+Analyze the customer's purchase history and provide 3 specific product recommendations.
+Return ONLY pure JSON with NO additional text before or after.
+Use this exact format:
+{
+    "recommendations": [
+        {
+            "item": "Product Name",
+            "reason": "Clear explanation why this matches their interests",
+            "confidence": 75
+        }
+    ]
+}
+The item should be a realistic product name, not generic terms like 'electronics' or 'clothing'."""
+}
+
+# Structured output for single-customer calls; the schema root must be an object
+_RECOMMENDATIONS_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "recommendations",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "recommendations": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "item": {"type": "string"},
+                            "reason": {"type": "string"},
+                            "confidence": {"type": "integer"}
+                        },
+                        "required": ["item", "reason", "confidence"],
+                        "additionalProperties": False
+                    }
+                }
+            },
+            "required": ["recommendations"],
+            "additionalProperties": False
+        }
+    }
+}
+
+_USER_PROMPT_TEMPLATE = """Customer Purchase History:
+{history_text}
+
+Based on this customer's purchase history, recommend 3 specific products they would be interested in.
+Consider:
+1. Complementary products to their purchases
+2. Related items in the same category
+3. Popular items that match their interests
+
+Return exactly 3 recommendations in JSON format. Each item should have:
+- item: Specific product name (e.g., 'Wireless Mouse', 'Cookbook', 'Running Shoes')
+- reason: Why this recommendation fits their profile (2-3 sentences)
+- confidence: 0-100 score based on how well it matches their history
+
+IMPORTANT: Return ONLY the JSON object, no other text."""
+
+_BATCH_SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": """You are a helpful shopping assistant specialized in e-commerce recommendations.
+You will receive the purchase histories of several customers, each under a numbered heading.
+For EACH customer provide 3 specific product recommendations.
+Return ONLY pure JSON with NO additional text before or after.
+Use this exact format, keyed by customer number:
+{
+    "1": [
+        {
+            "item": "Product Name",
+            "reason": "Clear explanation why this matches their interests",
+            "confidence": 75
+        }
+    ]
+}
+The item should be a realistic product name, not generic terms like 'electronics' or 'clothing'."""
+}
+
+_BATCH_USER_PROMPT_TEMPLATE = """{customer_blocks}
+
+For each customer, recommend 3 specific products they would be interested in, considering
+complementary products, related items in the same category and popular matching items.
+Each item should have:
+- item: Specific product name (e.g., 'Wireless Mouse', 'Cookbook', 'Running Shoes')
+- reason: Why this recommendation fits their profile (2-3 sentences)
+- confidence: 0-100 score based on how well it matches their history
+
+IMPORTANT: Return ONLY the JSON object keyed by customer number, no other text."""
+
+
+# Rule-based fallback catalogue (categories and products from products.json)
+_FALLBACK_RULE_DATA = (
+    # Electronics recommendations (from products.json)
+    {
+        "keywords": ("laptop", "zenbook", "computer", "notebook"),
+        "recommendations": (
+            {"item": "AlphaSound Wireless ANC Earbuds", "reason": "Premium audio companion for your laptop", "confidence": 90},
+            {"item": "Bluetooth Fitness Smartwatch", "reason": "Sync with your laptop for productivity", "confidence": 85},
+            {"item": "Wireless Ergonomic Keyboard & Mouse Combo", "reason": "Enhance your laptop setup", "confidence": 80}
+        )
+    },
+    {
+        "keywords": ("earbuds", "alphaSound", "audio", "headphones"),
+        "recommendations": (
+            {"item": "Noise-Cancelling Over-Ear Headphones", "reason": "Alternative high-quality audio option", "confidence": 85},
+            {"item": "Bluetooth Fitness Smartwatch", "reason": "Perfect companion for active lifestyle", "confidence": 80},
+            {"item": "USB-C 65W Fast Charger Adapter", "reason": "Essential charging solution", "confidence": 75}
         )
+    },
+    {
+        "keywords": ("smartwatch", "fitness", "bluetooth"),
+        "recommendations": (
+            {"item": "AlphaSound Wireless ANC Earbuds", "reason": "Great for workouts and daily use", "confidence": 85},
+            {"item": "Wireless Ergonomic Keyboard & Mouse Combo", "reason": "Complete your smart setup", "confidence": 80},
+            {"item": "USB-C 65W Fast Charger Adapter", "reason": "Keep all devices charged", "confidence": 75}
+        )
+    },
+    # Clothing recommendations (from products.json)
+    {
+        "keywords": ("jacket", "denim", "heritage", "outerwear"),
+        "recommendations": (
+            {"item": "Urban Stretch Slim Fit Chinos", "reason": "Perfect pairing with your jacket", "confidence": 85},
+            {"item": "Classic Polo Shirt (Men)", "reason": "Great layering option", "confidence": 80},
+            {"item": "Unisex Cotton Crew-Neck T-Shirt (Pack of 2)", "reason": "Versatile base layer", "confidence": 75}
+        )
+    },
+    {
+        "keywords": ("jeans", "chinos", "pants", "trousers"),
+        "recommendations": (
+            {"item": "Classic Leather Belt (Brown)", "reason": "Essential accessory for pants", "confidence": 90},
+            {"item": "Classic Polo Shirt (Men)", "reason": "Complete your casual look", "confidence": 85},
+            {"item": "Athletic Running Shorts (Unisex)", "reason": "Versatile addition to wardrobe", "confidence": 80}
+        )
+    },
+    {
+        "keywords": ("dress", "maxi", "boho", "fashion"),
+        "recommendations": (
+            {"item": "Classic Leather Belt (Brown)", "reason": "Accent your dress perfectly", "confidence": 85},
+            {"item": "Unisex Cotton Crew-Neck T-Shirt (Pack of 2)", "reason": "Comfortable casual option", "confidence": 80},
+            {"item": "Athletic Running Shorts (Unisex)", "reason": "Great for layering", "confidence": 75}
+        )
+    },
+    # Books recommendations (from products.json)
+    {
+        "keywords": ("python", "programming", "mastering", "coding", "sqlalchemy"),
+        "recommendations": (
+            {"item": "Deep Learning Essentials: From Scratch to Production", "reason": "Advance your technical skills", "confidence": 95},
+            {"item": "History of Ancient Civilizations (Vol. I)", "reason": "Expand your knowledge base", "confidence": 85},
+            {"item": "Mindfulness & Minimalist Living", "reason": "Balance technical work with mindfulness", "confidence": 80}
+        )
+    },
+    {
+        "keywords": ("cookbook", "cooking", "culinary", "recipes"),
+        "recommendations": (
+            {"item": "The Quantum Architect (Hardcover)", "reason": "Inspire creativity beyond cooking", "confidence": 85},
+            {"item": "Mindfulness & Minimalist Living", "reason": "Complement your cooking lifestyle", "confidence": 80},
+            {"item": "Children's Illustrated Fairy Tales", "reason": "Perfect for family cooking time", "confidence": 75}
+        )
+    },
+    # Home recommendations (from products.json)
+    {
+        "keywords": ("bed sheet", "bedding", "cotton", "sleep"),
+        "recommendations": (
+            {"item": "LED Desk Lamp with Adjustable Arm", "reason": "Perfect reading companion", "confidence": 90},
+            {"item": "Memory Foam Lumbar Support Cushion", "reason": "Enhance your bedroom seating", "confidence": 85},
+            {"item": "Aroma Scented Candle (Pack of 3)", "reason": "Create cozy bedroom atmosphere", "confidence": 80}
+        )
+    },
+    {
+        "keywords": ("bookshelf", "storage", "organization", "wall-mount"),
+        "recommendations": (
+            {"item": "LED Desk Lamp with Adjustable Arm", "reason": "Perfect for your organized workspace", "confidence": 85},
+            {"item": "Memory Foam Lumbar Support Cushion", "reason": "Comfort for long organizing sessions", "confidence": 80},
+            {"item": "Cotton Canvas Storage Box (Set of 3)", "reason": "Additional storage solutions", "confidence": 75}
+        )
+    }
+)
+
+_GENERAL_RECOMMENDATION_DATA = (
+    {"item": "Premium Merino Wool V-Neck Sweater", "reason": "Timeless wardrobe essential", "confidence": 80},
+    {"item": "4K Smart LED TV 55\"", "reason": "Popular home entertainment choice", "confidence": 75},
+    {"item": "Men's Waterproof Windbreaker Jacket", "reason": "Practical and versatile option", "confidence": 70}
+)
+
+
+def _freeze_recommendations(recommendations: Tuple[Dict[str, Any], ...]) -> Tuple[Mapping[str, Any], ...]:
+    """Wrap static recommendation dicts in read-only views"""
+    return tuple(MappingProxyType(rec) for rec in recommendations)
+
+
+# The catalogue is shared by every call, so expose it read-only; callers receive copies
+_FALLBACK_RULES = tuple(
+    MappingProxyType({
+        "keywords": rule["keywords"],
+        "recommendations": _freeze_recommendations(rule["recommendations"])
+    })
+    for rule in _FALLBACK_RULE_DATA
+)
+_GENERAL_RECOMMENDATIONS = _freeze_recommendations(_GENERAL_RECOMMENDATION_DATA)
+
+
+def _build_keyword_index() -> Dict[str, Tuple[int, ...]]:
+    """Map each casefolded fallback keyword to the indexes of the rules it triggers"""
+    keyword_rules: Dict[str, Tuple[int, ...]] = {}
+    for rule_index, rule in enumerate(_FALLBACK_RULES):
+        for keyword in rule["keywords"]:
+            keyword = keyword.casefold()
+            keyword_rules[keyword] = keyword_rules.get(keyword, ()) + (rule_index,)
+    return keyword_rules
+
+
+_FALLBACK_KEYWORD_RULES = _build_keyword_index()
+
+
+class AIService:
+    """AI service for generating recommendations using OpenAI-compatible API"""
+    
+    def __init__(self, client: Optional[AsyncOpenAI] = None, max_concurrency: int = 16):
+        # The client is injected (see get_openai_client); None means no LLM is configured
+        self.client = client
         self.model = settings.llm_model
+        # Client-side backpressure so bursts queue here instead of tripping provider rate limits
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        # Settings are fixed for the process lifetime, so decide once
+        self._configured = bool(client is not None and client.api_key and settings.llm_base_url and self.model)
+        # response_format types the backend answered with 400; later calls omit them
+        self._rejected_formats: Set[str] = set()
     
     def is_configured(self) -> bool:
         """Check if AI service is properly configured"""
-        return all([self.client.api_key, settings.llm_base_url, self.model])
+        return self._configured
     
     async def get_recommendations(self, purchase_history: List[str]) -> List[Dict[str, Any]]:
         """
@@ -33,76 +360,45 @@ class AIService:
         Returns:
             List of recommended items with details
         """
+        recommendations, _ = await self.generate_recommendations(purchase_history)
+        return recommendations
+    
+    async def generate_recommendations(self, purchase_history: List[str]) -> Tuple[List[Dict[str, Any]], bool]:
+        """
+        Get recommendations and report whether the LLM produced them
+        
+        Args:
+            purchase_history: List of past purchase descriptions
+            
+        Returns:
+            Recommended items, and False when they are the rule-based fallback
+        """
         logger.info(f"AI Service: Getting recommendations for purchase history: {purchase_history}")
         
+        # Built once and shared by the prompt and any fallback
+        history_text = _format_history(purchase_history)
+        
         # Check if AI is configured
-        if not self.is_configured():
+        if not self._configured:
             logger.warning("AI Service: Not configured, using fallback recommendations")
             logger.info(f"AI Service: LLM_API_KEY: {'***' if settings.llm_api_key else 'None'}")
             logger.info(f"AI Service: LLM_BASE_URL: {settings.llm_base_url}")
             logger.info(f"AI Service: LLM_MODEL: {settings.llm_model}")
-            return self._get_fallback_recommendations(purchase_history)
+            return self._get_fallback_recommendations(purchase_history, history_text), False
         
         logger.info(f"AI Service: Using model '{self.model}' with base URL '{settings.llm_base_url}'")
         
-        # Build enhanced system prompt
-        system_prompt = """You are a helpful shopping assistant specialized in e-commerce recommendations. 
-        Analyze the customer's purchase history and provide 3 specific product recommendations.
-        Return ONLY pure JSON with NO additional text before or after.
-        Use this exact format:
-        [
-            {
-                "item": "Product Name",
-                "reason": "Clear explanation why this matches their interests",
-                "confidence": 75
-            }
-        ]
-        The item should be a realistic product name, not generic terms like 'electronics' or 'clothing'."""
-        
-        # Build enhanced user prompt with context
-        history_text = "\n".join([f"- {item}" for item in purchase_history])
-        user_prompt = f"""Customer Purchase History:
-{history_text}
-
-Based on this customer's purchase history, recommend 3 specific products they would be interested in.
-Consider:
-1. Complementary products to their purchases
-2. Related items in the same category
-3. Popular items that match their interests
-
-Return exactly 3 recommendations in JSON format. Each item should have:
-- item: Specific product name (e.g., 'Wireless Mouse', 'Cookbook', 'Running Shoes')
-- reason: Why this recommendation fits their profile (2-3 sentences)
-- confidence: 0-100 score based on how well it matches their history
-
-IMPORTANT: Return ONLY the JSON array, no other text."""
-        
-        logger.debug(f"AI Service: System prompt: {system_prompt}")
-        logger.debug(f"AI Service: User prompt: {user_prompt}")
+        # Only the purchase history varies; the prompt skeletons are prebuilt
+        user_prompt = _USER_PROMPT_TEMPLATE.format(history_text=history_text)
         
         try:
-            logger.info("AI Service: Making API call to LLM...")
-            
-            # Make API call with enhanced parameters
-            response = await self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
-                temperature=0.7,  # Balanced creativity
-                max_tokens=800,   # Increased for detailed responses
-                top_p=0.9,
-                frequency_penalty=0.1,
-                presence_penalty=0.1
+            content = await self._stream_completion(
+                _SYSTEM_MESSAGE,
+                user_prompt,
+                max_tokens=800,
+                response_format=_RECOMMENDATIONS_RESPONSE_FORMAT
             )
             
-            logger.info(f"AI Service: API call successful, response usage: {getattr(response, 'usage', 'N/A')}")
-            
-            # Extract response content
-            content = response.choices[0].message.content
-            logger.debug(f"AI Service: Raw AI response: {content}")
-            
             # Parse JSON response
             recommendations = self._parse_ai_response(content)
             
@@ -111,10 +407,10 @@ IMPORTANT: Return ONLY the JSON array, no other text."""
             # If AI didn't return valid recommendations, use fallback
             if not recommendations:
                 logger.warning("AI Service: AI returned no valid recommendations, using fallback")
-                return self._get_fallback_recommendations(purchase_history)
+                return self._get_fallback_recommendations(purchase_history, history_text), False
             
             logger.info(f"AI Service: Successfully generated {len(recommendations)} AI recommendations")
-            return recommendations
+            return recommendations, True
             
         except Exception as e:
             # Log detailed error information
@@ -122,7 +418,275 @@ IMPORTANT: Return ONLY the JSON array, no other text."""
             logger.error(f"AI Service: Falling back to rule-based recommendations")
             
             # Fallback to rule-based recommendations
-            return self._get_fallback_recommendations(purchase_history)
+            return self._get_fallback_recommendations(purchase_history, history_text), False
+    
+    async def stream_recommendations(self, purchase_history: List[str]) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Yield AI recommendations one at a time as each JSON object completes
+        
+        Args:
+            purchase_history: List of past purchase descriptions
+            
+        Returns:
+            Async iterator of recommended items, falling back to rules if none arrive
+        """
+        history_text = _format_history(purchase_history)
+        
+        if self._configured:
+            user_prompt = _USER_PROMPT_TEMPLATE.format(history_text=history_text)
+            parser = _IncrementalObjectParser()
+            content_parts = []
+            streamed = 0
+            
+            try:
+                async for delta in self._stream_deltas(
+                    _SYSTEM_MESSAGE,
+                    user_prompt,
+                    max_tokens=800,
+                    response_format=_RECOMMENDATIONS_RESPONSE_FORMAT
+                ):
+                    content_parts.append(delta)
+                    for recommendation in self._normalize_recommendations(parser.feed(delta)):
+                        streamed += 1
+                        yield recommendation
+            except Exception as e:
+                logger.error(f"AI Service: Streaming API call failed with error: {e}", exc_info=True)
+            
+            # Anything already sent stands; only fill in when the model produced nothing usable
+            if streamed:
+                return
+            
+            # Providers that ignore the schema may answer with a lone object or plain text
+            recommendations = self._parse_ai_response("".join(content_parts)) if content_parts else []
+            if recommendations:
+                for recommendation in recommendations:
+                    yield recommendation
+                return
+        
+        for recommendation in self._get_fallback_recommendations(purchase_history, history_text):
+            yield recommendation
+    
+    async def get_batch_recommendations(self, purchase_histories: List[List[str]]) -> List[List[Dict[str, Any]]]:
+        """
+        Get AI recommendations for several customers with a single LLM call
+        
+        Args:
+            purchase_histories: One list of past purchase descriptions per customer
+            
+        Returns:
+            One list of recommended items per customer, in input order
+        """
+        return [recommendations for recommendations, _ in await self.generate_batch_recommendations(purchase_histories)]
+    
+    async def generate_batch_recommendations(
+        self,
+        purchase_histories: List[List[str]]
+    ) -> List[Tuple[List[Dict[str, Any]], bool]]:
+        """
+        Get batched recommendations and report, per customer, whether the LLM produced them
+        
+        Args:
+            purchase_histories: One list of past purchase descriptions per customer
+            
+        Returns:
+            One (recommended items, produced by LLM) pair per customer, in input order
+        """
+        logger.info(f"AI Service: Getting batched recommendations for {len(purchase_histories)} customers")
+        
+        history_texts = [_format_history(history) for history in purchase_histories]
+        
+        if not self._configured:
+            logger.warning("AI Service: Not configured, using fallback recommendations")
+            return [
+                (self._get_fallback_recommendations(history, history_text), False)
+                for history, history_text in zip(purchase_histories, history_texts)
+            ]
+        
+        customer_blocks = "\n\n".join(
+            f"Customer {number} Purchase History:\n{history_text}"
+            for number, history_text in enumerate(history_texts, start=1)
+        )
+        user_prompt = _BATCH_USER_PROMPT_TEMPLATE.format(customer_blocks=customer_blocks)
+        
+        try:
+            # The batch reply is a single object keyed by customer, so JSON mode applies
+            content = await self._stream_completion(
+                _BATCH_SYSTEM_MESSAGE,
+                user_prompt,
+                max_tokens=800 * len(purchase_histories),
+                response_format={"type": "json_object"}
+            )
+            batch = self._parse_batch_response(content, len(purchase_histories))
+        except Exception as e:
+            logger.error(f"AI Service: Batched API call failed with error: {e}", exc_info=True)
+            batch = [[] for _ in purchase_histories]
+        
+        # Fall back per customer when the model skipped or garbled their entry
+        return [
+            (recommendations, True) if recommendations
+            else (self._get_fallback_recommendations(history, history_text), False)
+            for recommendations, history, history_text in zip(batch, purchase_histories, history_texts)
+        ]
+    
+    async def _stream_completion(
+        self,
+        system_message: Dict[str, str],
+        user_prompt: str,
+        max_tokens: int,
+        response_format: Optional[Dict[str, Any]] = None
+    ) -> str:
+        """
+        Stream a chat completion and return the accumulated content
+        
+        Args:
+            system_message: Prebuilt system message
+            user_prompt: User message content
+            max_tokens: Upper bound on generated tokens
+            response_format: Optional structured output mode (JSON object mode or a nested json_schema spec)
+            
+        Returns:
+            Full response content
+        """
+        # Accumulate streamed deltas as they arrive
+        content_parts = [
+            delta async for delta in self._stream_deltas(system_message, user_prompt, max_tokens, response_format)
+        ]
+        content = "".join(content_parts)
+        
+        logger.info(f"AI Service: API stream completed, received {len(content_parts)} chunks")
+        logger.debug(f"AI Service: Raw AI response: {content}")
+        return content
+    
+    async def _stream_deltas(
+        self,
+        system_message: Dict[str, str],
+        user_prompt: str,
+        max_tokens: int,
+        response_format: Optional[Dict[str, Any]] = None
+    ) -> AsyncIterator[str]:
+        """
+        Stream a chat completion, yielding content deltas as they are generated
+        
+        Args:
+            system_message: Prebuilt system message
+            user_prompt: User message content
+            max_tokens: Upper bound on generated tokens
+            response_format: Optional structured output mode (JSON object mode or a nested json_schema spec)
+            
+        Returns:
+            Async iterator of content fragments
+        """
+        logger.debug(f"AI Service: System prompt: {system_message['content']}")
+        logger.debug(f"AI Service: User prompt: {user_prompt}")
+        logger.info("AI Service: Making API call to LLM...")
+        
+        # Skip a format this backend already rejected instead of paying for another 400
+        if response_format and response_format["type"] in self._rejected_formats:
+            response_format = None
+        
+        async with self._semaphore:
+            try:
+                stream = await self._create_stream(system_message, user_prompt, max_tokens, response_format)
+            except BadRequestError as e:
+                # Some OpenAI-compatible backends reject json_schema/json_object outright;
+                # retry once without it and let the text parsing fallback handle the reply
+                if not response_format:
+                    raise
+                logger.warning(f"AI Service: Backend rejected response_format {response_format['type']!r} ({e}); retrying without it")
+                self._rejected_formats.add(response_format["type"])
+                stream = await self._create_stream(system_message, user_prompt, max_tokens)
+            
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+    
+    async def _create_stream(
+        self,
+        system_message: Dict[str, str],
+        user_prompt: str,
+        max_tokens: int,
+        response_format: Optional[Dict[str, Any]] = None
+    ) -> AsyncIterator[Any]:
+        """Open a streaming chat completion, sending response_format only when given"""
+        # Only send response_format when requested; not every compatible backend accepts it
+        extra_params = {"response_format": response_format} if response_format else {}
+        
+        # Make streaming API call with enhanced parameters
+        return await self.client.chat.completions.create(
+            model=self.model,
+            messages=[
+                system_message,
+                {"role": "user", "content": user_prompt}
+            ],
+            temperature=0.7,  # Balanced creativity
+            max_tokens=max_tokens,
+            top_p=0.9,
+            frequency_penalty=0.1,
+            presence_penalty=0.1,
+            stream=True,      # Receive tokens as they are generated
+            **extra_params
+        )
+    
+    def _parse_batch_response(self, content: str, size: int) -> List[List[Dict[str, Any]]]:
+        """
+        Parse a batched AI response into one recommendation list per customer
+        
+        Args:
+            content: Raw AI response content
+            size: Number of customers in the batch
+            
+        Returns:
+            Recommendation lists in customer order (empty where missing)
+        """
+        json_content = _extract_json_payload(content)
+        
+        try:
+            parsed = _json_loads(json_content)
+        except orjson.JSONDecodeError:
+            return [[] for _ in range(size)]
+        
+        if isinstance(parsed, dict):
+            entries = [parsed.get(str(number)) for number in range(1, size + 1)]
+        elif isinstance(parsed, list) and len(parsed) == size:
+            entries = parsed
+        else:
+            entries = [None] * size
+        
+        return [self._normalize_recommendations(entry) for entry in entries]
+    
+    def _normalize_recommendations(self, parsed: Any) -> List[Dict[str, Any]]:
+        """
+        Validate parsed JSON and format it as recommendation dicts
+        
+        Args:
+            parsed: Decoded JSON for one customer ({"recommendations": [...]}, a list of items or a single item)
+            
+        Returns:
+            List of formatted recommendations
+        """
+        # Unwrap the structured-output envelope
+        if isinstance(parsed, dict) and isinstance(parsed.get("recommendations"), list):
+            parsed = parsed["recommendations"]
+        
+        # Coerce types here so responses can be built without re-validation
+        if isinstance(parsed, list):
+            return [
+                {
+                    "item": str(rec.get("item", "")),
+                    "reason": str(rec.get("reason") or ""),
+                    "confidence": int(min(100, max(0, rec.get("confidence", 50))))
+                }
+                for rec in parsed
+                if isinstance(rec, dict) and rec.get("item")
+            ]
+        elif isinstance(parsed, dict):
+            return [{
+                "item": str(parsed.get("item", "")),
+                "reason": str(parsed.get("reason") or ""),
+                "confidence": int(min(100, max(0, parsed.get("confidence", 50))))
+            }]
+        
+        return []
     
     def _parse_ai_response(self, content: str) -> List[Dict[str, Any]]:
         """
@@ -134,183 +698,82 @@ IMPORTANT: Return ONLY the JSON array, no other text."""
         Returns:
             List of parsed recommendations
         """
+        # Structured output returns bare JSON, so try it directly first
+        try:
+            return self._normalize_recommendations(_json_loads(content))
+        except orjson.JSONDecodeError:
+            pass
+        
+        # Providers without schema support may wrap JSON in a fenced block
+        json_content = _extract_json_payload(content).strip()
+        
+        # Truncated payloads can never parse whole; keep whichever objects did complete
+        if json_content[-1:] not in ("}", "]"):
+            salvaged = self._normalize_recommendations(_IncrementalObjectParser().feed(json_content))
+            return salvaged or self._extract_from_text(content)
+        
         try:
-            # Try to extract JSON from response
-            if "```json" in content:
-                json_content = content.split("```json")[1].split("```")[0]
-            elif "```" in content:
-                json_content = content.split("```")[1].split("```")[0]
-            else:
-                json_content = content
-            
             # Parse JSON
-            parsed = json.loads(json_content)
+            parsed = _json_loads(json_content)
             
             # Validate and format recommendations
-            if isinstance(parsed, list):
-                return [
-                    {
-                        "item": rec.get("item", ""),
-                        "reason": rec.get("reason", ""),
-                        "confidence": min(100, max(0, rec.get("confidence", 50)))
-                    }
-                    for rec in parsed
-                    if rec.get("item")
-                ]
-            elif isinstance(parsed, dict):
-                return [{
-                    "item": parsed.get("item", ""),
-                    "reason": parsed.get("reason", ""),
-                    "confidence": min(100, max(0, parsed.get("confidence", 50)))
-                }]
+            return self._normalize_recommendations(parsed)
             
-        except json.JSONDecodeError:
+        except orjson.JSONDecodeError:
             # If JSON parsing fails, try to extract recommendations from text
             return self._extract_from_text(content)
-        
-        return []
     
-    def _get_fallback_recommendations(self, purchase_history: List[str]) -> List[Dict[str, Any]]:
+    def _get_fallback_recommendations(
+        self,
+        purchase_history: List[str],
+        history_text: Optional[str] = None
+    ) -> List[Dict[str, Any]]:
         """
         Generate rule-based recommendations when AI is not available
         
         Args:
             purchase_history: List of past purchase descriptions
+            history_text: The history already rendered by _format_history, if the caller has it
             
         Returns:
             List of fallback recommendations based on purchase patterns
         """
         logger.info(f"AI Service: Using fallback recommendations for history: {purchase_history}")
         
-        recommendations = []
-        
-        # Analyze purchase history for patterns
-        history_text = " ".join(purchase_history).lower()
+        # Analyze purchase history for patterns; one line per item so keywords cannot span items
+        if history_text is None:
+            history_text = _format_history(purchase_history)
+        history_text = history_text.casefold()
         logger.debug(f"AI Service: Analyzing history text: {history_text}")
         
-        # Define recommendation rules based on categories and products from products.json
-        rules = [
-            # Electronics recommendations (from products.json)
-            {
-                "keywords": ["laptop", "zenbook", "computer", "notebook"],
-                "recommendations": [
-                    {"item": "AlphaSound Wireless ANC Earbuds", "reason": "Premium audio companion for your laptop", "confidence": 90},
-                    {"item": "Bluetooth Fitness Smartwatch", "reason": "Sync with your laptop for productivity", "confidence": 85},
-                    {"item": "Wireless Ergonomic Keyboard & Mouse Combo", "reason": "Enhance your laptop setup", "confidence": 80}
-                ]
-            },
-            {
-                "keywords": ["earbuds", "alphaSound", "audio", "headphones"],
-                "recommendations": [
-                    {"item": "Noise-Cancelling Over-Ear Headphones", "reason": "Alternative high-quality audio option", "confidence": 85},
-                    {"item": "Bluetooth Fitness Smartwatch", "reason": "Perfect companion for active lifestyle", "confidence": 80},
-                    {"item": "USB-C 65W Fast Charger Adapter", "reason": "Essential charging solution", "confidence": 75}
-                ]
-            },
-            {
-                "keywords": ["smartwatch", "fitness", "bluetooth"],
-                "recommendations": [
-                    {"item": "AlphaSound Wireless ANC Earbuds", "reason": "Great for workouts and daily use", "confidence": 85},
-                    {"item": "Wireless Ergonomic Keyboard & Mouse Combo", "reason": "Complete your smart setup", "confidence": 80},
-                    {"item": "USB-C 65W Fast Charger Adapter", "reason": "Keep all devices charged", "confidence": 75}
-                ]
-            },
-            # Clothing recommendations (from products.json)
-            {
-                "keywords": ["jacket", "denim", "heritage", "outerwear"],
-                "recommendations": [
-                    {"item": "Urban Stretch Slim Fit Chinos", "reason": "Perfect pairing with your jacket", "confidence": 85},
-                    {"item": "Classic Polo Shirt (Men)", "reason": "Great layering option", "confidence": 80},
-                    {"item": "Unisex Cotton Crew-Neck T-Shirt (Pack of 2)", "reason": "Versatile base layer", "confidence": 75}
-                ]
-            },
-            {
-                "keywords": ["jeans", "chinos", "pants", "trousers"],
-                "recommendations": [
-                    {"item": "Classic Leather Belt (Brown)", "reason": "Essential accessory for pants", "confidence": 90},
-                    {"item": "Classic Polo Shirt (Men)", "reason": "Complete your casual look", "confidence": 85},
-                    {"item": "Athletic Running Shorts (Unisex)", "reason": "Versatile addition to wardrobe", "confidence": 80}
-                ]
-            },
-            {
-                "keywords": ["dress", "maxi", "boho", "fashion"],
-                "recommendations": [
-                    {"item": "Classic Leather Belt (Brown)", "reason": "Accent your dress perfectly", "confidence": 85},
-                    {"item": "Unisex Cotton Crew-Neck T-Shirt (Pack of 2)", "reason": "Comfortable casual option", "confidence": 80},
-                    {"item": "Athletic Running Shorts (Unisex)", "reason": "Great for layering", "confidence": 75}
-                ]
-            },
-            # Books recommendations (from products.json)
-            {
-                "keywords": ["python", "programming", "mastering", "coding", "sqlalchemy"],
-                "recommendations": [
-                    {"item": "Deep Learning Essentials: From Scratch to Production", "reason": "Advance your technical skills", "confidence": 95},
-                    {"item": "History of Ancient Civilizations (Vol. I)", "reason": "Expand your knowledge base", "confidence": 85},
-                    {"item": "Mindfulness & Minimalist Living", "reason": "Balance technical work with mindfulness", "confidence": 80}
-                ]
-            },
-            {
-                "keywords": ["cookbook", "cooking", "culinary", "recipes"],
-                "recommendations": [
-                    {"item": "The Quantum Architect (Hardcover)", "reason": "Inspire creativity beyond cooking", "confidence": 85},
-                    {"item": "Mindfulness & Minimalist Living", "reason": "Complement your cooking lifestyle", "confidence": 80},
-                    {"item": "Children's Illustrated Fairy Tales", "reason": "Perfect for family cooking time", "confidence": 75}
-                ]
-            },
-            # Home recommendations (from products.json)
-            {
-                "keywords": ["bed sheet", "bedding", "cotton", "sleep"],
-                "recommendations": [
-                    {"item": "LED Desk Lamp with Adjustable Arm", "reason": "Perfect reading companion", "confidence": 90},
-                    {"item": "Memory Foam Lumbar Support Cushion", "reason": "Enhance your bedroom seating", "confidence": 85},
-                    {"item": "Aroma Scented Candle (Pack of 3)", "reason": "Create cozy bedroom atmosphere", "confidence": 80}
-                ]
-            },
-            {
-                "keywords": ["bookshelf", "storage", "organization", "wall-mount"],
-                "recommendations": [
-                    {"item": "LED Desk Lamp with Adjustable Arm", "reason": "Perfect for your organized workspace", "confidence": 85},
-                    {"item": "Memory Foam Lumbar Support Cushion", "reason": "Comfort for long organizing sessions", "confidence": 80},
-                    {"item": "Cotton Canvas Storage Box (Set of 3)", "reason": "Additional storage solutions", "confidence": 75}
-                ]
-            }
-        ]
-        
-        # Apply rules to generate recommendations
-        applied_rules = set()
+        # Each distinct keyword is tested once with C-level substring search
+        matched_rules = {
+            rule_index
+            for keyword, rule_indexes in _FALLBACK_KEYWORD_RULES.items()
+            if keyword in history_text
+            for rule_index in rule_indexes
+        }
         
-        for rule in rules:
-            # Check if any keyword matches
-            if any(keyword in history_text for keyword in rule["keywords"]):
-                rule_name = "_".join(rule["keywords"][:2])  # Use first 2 keywords as rule identifier
-                if rule_name not in applied_rules:
-                    logger.info(f"AI Service: Matched rule with keywords: {rule['keywords']}")
-                    # Add recommendations from this rule
-                    for rec in rule["recommendations"]:
-                        recommendations.append(rec)
-                    applied_rules.add(rule_name)
+        # Apply rules in catalogue order; keying by item keeps the first occurrence of each
+        unique_recommendations: Dict[str, Mapping[str, Any]] = {}
+        for rule_index in sorted(matched_rules):
+            rule = _FALLBACK_RULES[rule_index]
+            logger.info(f"AI Service: Matched rule with keywords: {rule['keywords']}")
+            for rec in rule["recommendations"]:
+                unique_recommendations.setdefault(rec["item"], rec)
+            # Later rules cannot change the first 3 unique items
+            if len(unique_recommendations) >= 3:
+                break
         
         # If no rules matched, provide general recommendations from products.json
-        if not recommendations:
+        if not unique_recommendations:
             logger.warning("AI Service: No specific rules matched, using general recommendations")
-            recommendations = [
-                {"item": "Premium Merino Wool V-Neck Sweater", "reason": "Timeless wardrobe essential", "confidence": 80},
-                {"item": "4K Smart LED TV 55\"", "reason": "Popular home entertainment choice", "confidence": 75},
-                {"item": "Men's Waterproof Windbreaker Jacket", "reason": "Practical and versatile option", "confidence": 70}
-            ]
-        
-        # Limit to 3 recommendations and ensure uniqueness
-        seen = set()
-        unique_recommendations = []
-        for rec in recommendations:
-            if rec["item"] not in seen:
-                seen.add(rec["item"])
-                unique_recommendations.append(rec)
-            if len(unique_recommendations) >= 3:
-                break
+            return [dict(rec) for rec in _GENERAL_RECOMMENDATIONS]
         
-        logger.info(f"AI Service: Generated {len(unique_recommendations)} fallback recommendations")
-        return unique_recommendations
+        # Limit to 3 recommendations
+        recommendations = [dict(rec) for rec in list(unique_recommendations.values())[:3]]
+        logger.info(f"AI Service: Generated {len(recommendations)} fallback recommendations")
+        return recommendations
     
     def _extract_from_text(self, content: str) -> List[Dict[str, Any]]:
         """
@@ -345,3 +808,120 @@ IMPORTANT: Return ONLY the JSON array, no other text."""
                     break
         
         return recommendations
+
+
+class RecommendationBatcher:
+    """Coalesces concurrent recommendation requests into batched LLM calls"""
+    
+    def __init__(self, ai_service: AIService, window: float, max_batch_size: int):
+        self.ai_service = ai_service
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self._pending: List[Tuple[List[str], asyncio.Future]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._tasks: Set[asyncio.Task] = set()
+    
+    async def submit(self, purchase_history: List[str]) -> Tuple[List[Dict[str, Any]], bool]:
+        """
+        Queue a purchase history and wait for its recommendations
+        
+        Args:
+            purchase_history: List of past purchase descriptions
+            
+        Returns:
+            Recommended items, and whether the LLM produced them
+        """
+        # Nothing to coalesce when batching is off or every answer is a local fallback
+        if self.window <= 0 or self.max_batch_size <= 1 or not self.ai_service.is_configured():
+            return await self.ai_service.generate_recommendations(purchase_history)
+        
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((purchase_history, future))
+        
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.window, self._flush)
+        
+        return await future
+    
+    def _flush(self) -> None:
+        """Send everything collected in the current window as one batch"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        
+        batch, self._pending = self._pending, []
+        if batch:
+            # Keep a reference so the task is not garbage collected mid-flight
+            task = asyncio.create_task(self._run_batch(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+    
+    async def _run_batch(self, batch: List[Tuple[List[str], asyncio.Future]]) -> None:
+        """Resolve each waiting request with its share of the batched result"""
+        histories = [history for history, _ in batch]
+        
+        try:
+            if len(histories) == 1:
+                results = [await self.ai_service.generate_recommendations(histories[0])]
+            else:
+                logger.info(f"AI Service: Flushing batch of {len(histories)} recommendation requests")
+                results = await self.ai_service.generate_batch_recommendations(histories)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+
+@lru_cache
+def get_llm_http_client() -> httpx.AsyncClient:
+    """Pooled HTTP client for the LLM API, shared for the process lifetime"""
+    return httpx.AsyncClient(limits=_HTTP_LIMITS, timeout=_HTTP_TIMEOUT)
+
+
+async def prewarm_llm_connections(connections: int) -> None:
+    """Open keep-alive connections in the shared LLM pool so early requests skip TCP/TLS setup"""
+    client = get_llm_http_client()
+    results = await asyncio.gather(
+        *(client.head(settings.llm_base_url) for _ in range(connections)),
+        return_exceptions=True
+    )
+    failures = sum(isinstance(result, Exception) for result in results)
+    if failures:
+        logger.warning(f"{failures}/{connections} LLM connection pre-warm requests failed")
+
+
+@lru_cache
+def get_openai_client() -> Optional[AsyncOpenAI]:
+    """Dependency to provide the shared AsyncOpenAI client, or None without an API key"""
+    if not settings.llm_api_key:
+        return None
+    return AsyncOpenAI(
+        api_key=settings.llm_api_key,
+        base_url=settings.llm_base_url,
+        http_client=get_llm_http_client(),
+        max_retries=_MAX_RETRIES
+    )
+
+
+@lru_cache
+def get_ai_service(client: Optional[AsyncOpenAI] = Depends(get_openai_client)) -> AIService:
+    """Dependency to provide a shared AIService for the injected client"""
+    return AIService(client, max_concurrency=settings.llm_max_concurrency)
+
+
+@lru_cache
+def get_recommendation_batcher(ai_service: AIService = Depends(get_ai_service)) -> RecommendationBatcher:
+    """Dependency to provide the shared batcher in front of the AIService"""
+    return RecommendationBatcher(
+        ai_service,
+        window=settings.llm_batch_window_ms / 1000,
+        max_batch_size=settings.llm_batch_max_size
+    )
@@ -1,21 +1,22 @@
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
-from sqlalchemy.orm import selectinload
-from typing import List, Optional
+from sqlalchemy import insert, select
+from sqlalchemy.orm import joinedload, selectinload
+from typing import AsyncIterator, Optional
 
 from app.models.customer import Customer
+from app.models.order import Order
 from app.schemas.customer import CustomerCreate, CustomerWithHistory
 
 
 async def create_customer(db: AsyncSession, customer_data: CustomerCreate) -> Customer:
     """Create a new customer"""
-    db_customer = Customer(
-        name=customer_data.name,
-        email=customer_data.email
+    # RETURNING hands back generated columns in the INSERT round-trip, so no refresh
+    db_customer = await db.scalar(
+        insert(Customer)
+        .values(name=customer_data.name, email=customer_data.email)
+        .returning(Customer)
     )
-    db.add(db_customer)
     await db.commit()
-    await db.refresh(db_customer)
     return db_customer
 
 
@@ -31,40 +32,22 @@ async def get_customer_with_history(db: AsyncSession, customer_id: int) -> Optio
     """Get customer with order history"""
     result = await db.execute(
         select(Customer)
-        .options(selectinload(Customer.orders).selectinload(Customer.orders.property.mapper.class_.product))
+        # One IN query for the orders, with each order's product JOINed onto it
+        .options(selectinload(Customer.orders).joinedload(Order.product))
         .where(Customer.id == customer_id)
     )
     customer = result.scalar_one_or_none()
     
-    if customer:
-        # Convert to CustomerWithHistory schema
-        return CustomerWithHistory(
-            id=customer.id,
-            name=customer.name,
-            email=customer.email,
-            created_at=customer.created_at,
-            orders=[
-                {
-                    "id": order.id,
-                    "customer_id": order.customer_id,
-                    "product_id": order.product_id,
-                    "quantity": order.quantity,
-                    "purchase_date": order.purchase_date,
-                    "product": {
-                        "id": order.product.id,
-                        "name": order.product.name,
-                        "category": order.product.category,
-                        "price": order.product.price,
-                        "description": order.product.description
-                    } if order.product else None
-                }
-                for order in customer.orders
-            ]
-        )
-    return None
+    # Orders and products are already loaded, so pydantic-core can read them straight off the ORM objects
+    return CustomerWithHistory.model_validate(customer) if customer else None
 
 
-async def get_all_customers(db: AsyncSession) -> List[Customer]:
-    """Get all customers"""
-    result = await db.execute(select(Customer))
-    return result.scalars().all()
+async def get_all_customers(db: AsyncSession, batch_size: int = 500) -> AsyncIterator[Customer]:
+    """Stream all customers, fetching rows from the cursor in batches"""
+    result = await db.stream_scalars(
+        select(Customer)
+        .order_by(Customer.id)
+        .execution_options(yield_per=batch_size)
+    )
+    async for customer in result:
+        yield customer
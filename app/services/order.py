@@ -1,9 +1,10 @@
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
-from sqlalchemy.orm import selectinload
-from typing import List, Optional
+from sqlalchemy.orm import joinedload
+from typing import AsyncIterator, List, Optional
 
 from app.models.order import Order
+from app.models.product import Product
 from app.schemas.order import OrderCreate, OrderRead
 
 
@@ -16,7 +17,8 @@ async def create_order(db: AsyncSession, order_data: OrderCreate) -> Order:
     )
     db.add(db_order)
     await db.commit()
-    await db.refresh(db_order)
+    # Columns are already populated at flush; only the product needs loading
+    await db.refresh(db_order, attribute_names=["product"])
     return db_order
 
 
@@ -24,22 +26,51 @@ async def get_order_by_id(db: AsyncSession, order_id: int) -> Optional[Order]:
     """Get order by ID with product details"""
     result = await db.execute(
         select(Order)
-        .options(selectinload(Order.product))
+        .options(joinedload(Order.product))
         .where(Order.id == order_id)
     )
     return result.scalar_one_or_none()
 
 
-async def get_orders_by_customer(db: AsyncSession, customer_id: int) -> List[Order]:
-    """Get all orders for a specific customer with product details"""
-    result = await db.execute(
+async def get_orders_by_customer(
+    db: AsyncSession,
+    customer_id: int,
+    *,
+    limit: int = 100,
+    after_id: Optional[int] = None
+) -> List[Order]:
+    """Get one page of a customer's orders with product details, ordered by id"""
+    # Order -> Product is many-to-one, so a JOIN loads everything in one round-trip
+    query = (
         select(Order)
-        .options(selectinload(Order.product))
+        .options(joinedload(Order.product))
         .where(Order.customer_id == customer_id)
     )
+    
+    # Keyset pagination: seek past the last id seen instead of OFFSET scanning
+    if after_id is not None:
+        query = query.where(Order.id > after_id)
+    
+    result = await db.execute(query.order_by(Order.id).limit(limit))
     return result.scalars().all()
 
 
+async def get_purchase_history_by_customer(db: AsyncSession, customer_id: int) -> List[str]:
+    """Get a customer's purchases as "Name (Category: ...)" strings without loading ORM objects"""
+    result = await db.execute(
+        select(Product.name, Product.category)
+        .select_from(Order)
+        .outerjoin(Product, Order.product_id == Product.id)
+        .where(Order.customer_id == customer_id)
+        # Stable order: the joined history feeds the response cache key and ETag
+        .order_by(Order.id)
+    )
+    return [
+        f"{name or 'Unknown Product'} (Category: {category or 'Unknown Category'})"
+        for name, category in result
+    ]
+
+
 async def get_orders_by_product(db: AsyncSession, product_id: int) -> List[Order]:
     """Get all orders for a specific product"""
     result = await db.execute(
@@ -48,10 +79,14 @@ async def get_orders_by_product(db: AsyncSession, product_id: int) -> List[Order
     return result.scalars().all()
 
 
-async def get_all_orders(db: AsyncSession) -> List[Order]:
-    """Get all orders with product details"""
-    result = await db.execute(
+async def get_all_orders(db: AsyncSession, batch_size: int = 500) -> AsyncIterator[Order]:
+    """Stream all orders with product details, fetching rows from the cursor in batches"""
+    # joinedload is safe with yield_per here because Order -> Product is many-to-one
+    result = await db.stream_scalars(
         select(Order)
-        .options(selectinload(Order.product))
+        .options(joinedload(Order.product))
+        .order_by(Order.id)
+        .execution_options(yield_per=batch_size)
     )
-    return result.scalars().all()
+    async for order in result:
+        yield order
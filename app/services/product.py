@@ -1,34 +1,83 @@
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import insert, select
 from typing import List, Optional
 
+from app.core.cache import TTLCache
+from app.core.config import settings
 from app.models.product import Product
 from app.schemas.product import ProductCreate, ProductRead
 
 
+# Read-through cache of immutable product snapshots, keyed by product id plus one
+# entry for the full catalogue; products change rarely, so reads skip the database
+_product_cache = TTLCache(
+    maxsize=settings.product_cache_maxsize,
+    ttl=settings.product_cache_ttl
+)
+_ALL_PRODUCTS_KEY = "all"
+
+
 async def create_product(db: AsyncSession, product_data: ProductCreate) -> Product:
     """Create a new product"""
-    db_product = Product(
-        name=product_data.name,
-        category=product_data.category,
-        price=product_data.price,
-        description=product_data.description
+    # RETURNING hands back generated columns in the INSERT round-trip, so no refresh
+    db_product = await db.scalar(
+        insert(Product)
+        .values(
+            name=product_data.name,
+            category=product_data.category,
+            price=product_data.price,
+            description=product_data.description
+        )
+        .returning(Product)
     )
-    db.add(db_product)
     await db.commit()
-    await db.refresh(db_product)
+    
+    # The catalogue snapshot is now stale; the new row can be cached right away
+    _product_cache.pop(_ALL_PRODUCTS_KEY)
+    _product_cache.set(db_product.id, ProductRead.model_validate(db_product))
     return db_product
 
 
-async def get_product_by_id(db: AsyncSession, product_id: int) -> Optional[Product]:
+async def get_product_by_id(db: AsyncSession, product_id: int) -> Optional[ProductRead]:
     """Get product by ID"""
+    cached_product = _product_cache.get(product_id)
+    if cached_product is not None:
+        return cached_product
+    
     result = await db.execute(
         select(Product).where(Product.id == product_id)
     )
-    return result.scalar_one_or_none()
+    product = result.scalar_one_or_none()
+    if product is None:
+        return None
+    
+    snapshot = ProductRead.model_validate(product)
+    _product_cache.set(product_id, snapshot)
+    return snapshot
 
 
-async def get_all_products(db: AsyncSession) -> List[Product]:
-    """Get all products"""
-    result = await db.execute(select(Product))
-    return result.scalars().all()
+async def get_all_products(
+    db: AsyncSession,
+    *,
+    limit: Optional[int] = None,
+    after_id: Optional[int] = None
+) -> List[ProductRead]:
+    """Get all products ordered by id, optionally one keyset page at a time"""
+    # Pages are cut by the database so a small page never scans the whole table
+    if limit is not None or after_id is not None:
+        query = select(Product).order_by(Product.id)
+        if after_id is not None:
+            query = query.where(Product.id > after_id)
+        if limit is not None:
+            query = query.limit(limit)
+        result = await db.execute(query)
+        return [ProductRead.model_validate(product) for product in result.scalars()]
+    
+    # The full catalogue (used by recommendation scoring) is served from the cached snapshot
+    cached = _product_cache.get(_ALL_PRODUCTS_KEY)
+    if cached is None:
+        result = await db.execute(select(Product).order_by(Product.id))
+        cached = tuple(ProductRead.model_validate(product) for product in result.scalars())
+        _product_cache.set(_ALL_PRODUCTS_KEY, cached)
+    
+    return list(cached)
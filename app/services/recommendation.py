@@ -1,77 +1,340 @@
+import asyncio
+import heapq
 import httpx
-import json
-from typing import List, Dict, Any, Optional
+import orjson
+import logging
+import random
+from functools import lru_cache
+from hashlib import blake2b
+from typing import List, Dict, Any, Optional, Tuple
 from datetime import datetime, timedelta
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, func
-from sqlalchemy.orm import selectinload
+from sqlalchemy import bindparam, distinct, func, select
+from sqlalchemy.orm import sessionmaker
 
+from app.core.cache import TTLCache
 from app.core.config import settings
 from app.models.order import Order
 from app.models.product import Product
 from app.models.customer import Customer
+from app.db.session import run_in_session
+from app.services.ai_service import _IncrementalObjectParser, _extract_json_payload, _json_loads, get_llm_http_client
+from app.services.product import get_all_products
+
+
+logger = logging.getLogger(__name__)
+
+# The prompt asks for 3-5 items; stop reading the stream once this many have arrived
+_LLM_MAX_RECOMMENDATIONS = 5
+
+# Transient LLM failures are retried here rather than failing the whole pipeline;
+# the sleep happens outside the concurrency semaphore so other calls keep going
+_LLM_MAX_ATTEMPTS = 3
+_LLM_BACKOFF_BASE = 0.5  # seconds
+_LLM_BACKOFF_MAX = 10.0  # seconds
+_RETRYABLE_STATUS_CODES = frozenset({408, 409, 429, 500, 502, 503, 504})
+
+# Prompt skeleton and per-line formats, built once; only the values vary per request
+_RECOMMENDATION_PROMPT_TEMPLATE = """
+Based on the following customer context, provide personalized product recommendations:
+
+
+Customer: {customer_name}
+Total Orders: {total_orders}
+Total Spent: ${total_spent:.2f}
+Favorite Categories: {favorite_categories}
+Recent Purchases: {recent_purchases}
+
+
+Products bought by similar customers:
+{collab_info}
+
+Available products to recommend:
+{products_info}
+
+Please provide 3-5 product recommendations with reasons and confidence scores (0-100).
+Return your response as JSON with fields: product_id, reason, confidence_score.
+"""
+_COLLABORATIVE_LINE = "- {product_name} (Category: {category}, Price: ${price:.2f}) - Bought by {customer_count} similar customers".format
+_PRODUCT_LINE = "- ID: {id}, Name: {name}, Category: {category}, Price: ${price:.2f}".format
+
+
+def _format_collaborative_line(rec: Dict[str, Any]) -> str:
+    """Render one collaborative recommendation as a prompt line"""
+    return _COLLABORATIVE_LINE(**rec)
+
+
+def _format_product_line(product: Dict[str, Any]) -> str:
+    """Render one available product as a prompt line"""
+    return _PRODUCT_LINE(**product)
+
+
+# Purchase-history context per customer, invalidated when the customer places an order
+_context_cache = TTLCache(
+    maxsize=settings.recommendation_cache_maxsize,
+    ttl=settings.context_cache_ttl
+)
+# Per-customer loader lock and the number of callers holding or awaiting it
+_context_locks: Dict[int, Tuple[asyncio.Lock, int]] = {}
+# Bumped on every invalidation, so a load that started before one is never cached
+_context_generations: Dict[int, int] = {}
+
+# Parsed LLM recommendations keyed by a hash of model and prompt
+_llm_response_cache = TTLCache(
+    maxsize=settings.recommendation_cache_maxsize,
+    ttl=settings.llm_cache_ttl
+)
+
+
+def invalidate_customer_context(customer_id: int) -> None:
+    """Drop the cached purchase-history context for a customer"""
+    _context_generations[customer_id] = _context_generations.get(customer_id, 0) + 1
+    _context_cache.pop(customer_id)
+
+
+def _is_retryable(error: Exception) -> bool:
+    """Whether an LLM call failure is worth another attempt"""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code in _RETRYABLE_STATUS_CODES
+    return isinstance(error, httpx.TransportError)
+
+
+def _retry_delay(attempt: int, error: Exception) -> float:
+    """Seconds to wait before the next attempt: Retry-After if sent, else full-jitter exponential"""
+    if isinstance(error, httpx.HTTPStatusError):
+        retry_after = error.response.headers.get("Retry-After")
+        if retry_after is not None:
+            try:
+                return min(_LLM_BACKOFF_MAX, max(0.0, float(retry_after)))
+            except ValueError:
+                pass  # HTTP-date form; fall back to our own backoff
+    return random.uniform(0, min(_LLM_BACKOFF_MAX, _LLM_BACKOFF_BASE * 2 ** attempt))
+
+
+async def _fetch_rows(db: AsyncSession, query: Any, params: Dict[str, Any]) -> List[Any]:
+    """Execute a query and return all of its rows"""
+    result = await db.execute(query, params)
+    return result.all()
+
+
+# Hot recommendation queries are built once with bind parameters, so each call
+# skips statement construction and goes straight to the compiled-SQL cache.
+# They select plain columns; no ORM instances are hydrated.
+_CUSTOMER_QUERY = select(Customer.id, Customer.name).where(Customer.id == bindparam("customer_id"))
+
+# Category counts and spend, ordered by most recent purchase so preference ties stay stable
+_CATEGORY_QUERY = (
+    select(
+        Product.category,
+        func.count(Order.id),
+        func.sum(Product.price * Order.quantity)
+    )
+    .join(Product, Order.product_id == Product.id)
+    .where(Order.customer_id == bindparam("customer_id"))
+    .group_by(Product.category)
+    .order_by(func.max(Order.purchase_date).desc())
+)
+
+_RECENT_PURCHASES_QUERY = (
+    select(Order.purchase_date, Product.id, Product.name, Product.category)
+    .join(Product, Order.product_id == Product.id)
+    .where(Order.customer_id == bindparam("customer_id"))
+    .order_by(Order.purchase_date.desc())
+    .limit(5)  # Last 5 purchases
+)
+
+
+def _target_categories_query() -> Any:
+    """Distinct categories the target customer has bought from"""
+    return (
+        select(Product.category)
+        .join(Order, Order.product_id == Product.id)
+        .where(Order.customer_id == bindparam("customer_id"))
+        .distinct()
+    )
+
+
+def _build_similar_customers_query() -> Any:
+    """Other customers who bought in the target customer's categories, by shared purchases"""
+    shared_purchases = func.count(Order.id)
+    
+    return (
+        select(
+            Order.customer_id,
+            shared_purchases.label("shared_purchases"),
+            func.group_concat(distinct(Product.category)).label("categories")
+        )
+        .join(Product, Order.product_id == Product.id)
+        .where(Order.customer_id != bindparam("customer_id"))
+        .where(Product.category.in_(_target_categories_query()))
+        .group_by(Order.customer_id)
+        .order_by(shared_purchases.desc())
+        .limit(bindparam("limit"))
+    )
+
+
+def _build_neighbour_purchases_query(neighbour_ids: Any) -> Any:
+    """Products bought by the given customers, ranked by purchases then distinct buyers"""
+    # Ties go to the most recently bought product
+    purchase_count = func.count(Order.id)
+    customer_count = func.count(distinct(Order.customer_id))
+    
+    return (
+        select(
+            Product.id,
+            Product.name,
+            Product.category,
+            Product.price,
+            Product.description,
+            purchase_count.label("purchase_count"),
+            customer_count.label("customer_count")
+        )
+        .join(Order, Order.product_id == Product.id)
+        .where(
+            Order.customer_id.in_(neighbour_ids),
+            Order.product_id.not_in(bindparam("exclude_product_ids", expanding=True))
+        )
+        .group_by(Product.id)
+        .order_by(
+            purchase_count.desc(),
+            customer_count.desc(),
+            func.max(Order.purchase_date).desc()
+        )
+        .limit(10)  # Top 10 recommendations from similar customers
+    )
+
+
+def _build_collaborative_query() -> Any:
+    """Similar customers and their purchases in one statement, with the neighbours as a CTE"""
+    neighbours = (
+        select(Order.customer_id)
+        .join(Product, Order.product_id == Product.id)
+        .where(Order.customer_id != bindparam("customer_id"))
+        .where(Product.category.in_(_target_categories_query()))
+        .group_by(Order.customer_id)
+        .order_by(func.count(Order.id).desc())
+        .limit(bindparam("limit"))
+        .cte("neighbours")
+    )
+    return _build_neighbour_purchases_query(select(neighbours.c.customer_id))
+
+
+def _collaborative_row_to_dict(row: Any) -> Dict[str, Any]:
+    """Shape a neighbour-purchase row as a collaborative recommendation"""
+    return {
+        "product_id": row.id,
+        "product_name": row.name,
+        "category": row.category,
+        "price": row.price,
+        "description": row.description or "",
+        "purchase_count": row.purchase_count,
+        "customer_count": row.customer_count
+    }
+
+
+_SIMILAR_CUSTOMERS_QUERY = _build_similar_customers_query()
+_NEIGHBOUR_PURCHASES_QUERY = _build_neighbour_purchases_query(bindparam("customer_ids", expanding=True))
+_COLLABORATIVE_QUERY = _build_collaborative_query()
 
 
 class RecommendationService:
     """Service for generating product recommendations using OpenAI LLM"""
     
-    def __init__(self):
+    def __init__(self, max_concurrency: int = 16):
         self.api_key = settings.llm_api_key
         self.base_url = settings.llm_base_url
         self.model = settings.llm_model
-        
+        # Settings are fixed for the process lifetime, so decide once
+        self._configured = bool(self.api_key and self.base_url and self.model)
+        # Bound in-flight LLM calls, and let identical prompts share one call
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._inflight: Dict[str, asyncio.Task] = {}
+    
+    def _get_client(self) -> httpx.AsyncClient:
+        """Return the process-wide LLM HTTP pool shared with the AI service"""
+        return get_llm_http_client()
+    
     def is_configured(self) -> bool:
         """Check if LLM is properly configured"""
-        return all([self.api_key, self.base_url, self.model])
+        return self._configured
     
     async def get_customer_purchase_history(
         self, 
         db: AsyncSession, 
-        customer_id: int
+        customer_id: int,
+        session_factory: Optional[sessionmaker] = None
     ) -> Dict[str, Any]:
         """Get customer's purchase history for recommendation context"""
-        # Get customer details
-        customer_result = await db.execute(
-            select(Customer).where(Customer.id == customer_id)
-        )
-        customer = customer_result.scalar_one_or_none()
-        
-        if not customer:
-            return {}
+        cached_context = _context_cache.get(customer_id)
+        if cached_context is not None:
+            return cached_context
         
-        # Get customer's orders with product details
-        orders_result = await db.execute(
-            select(Order)
-            .options(selectinload(Order.product))
-            .where(Order.customer_id == customer_id)
-            .order_by(Order.purchase_date.desc())
-        )
-        orders = orders_result.scalars().all()
+        # One loader per customer; concurrent callers wait and reuse its result
+        lock, users = _context_locks.get(customer_id) or (asyncio.Lock(), 0)
+        _context_locks[customer_id] = (lock, users + 1)
+        try:
+            async with lock:
+                context = _context_cache.get(customer_id)
+                if context is None:
+                    generation = _context_generations.get(customer_id, 0)
+                    context = await self._load_customer_purchase_history(
+                        db, customer_id, session_factory
+                    )
+                    # An order committed mid-load makes this context stale
+                    if context and _context_generations.get(customer_id, 0) == generation:
+                        _context_cache.set(customer_id, context)
+        finally:
+            # Keep the lock while other callers still wait on it
+            lock, users = _context_locks[customer_id]
+            if users > 1:
+                _context_locks[customer_id] = (lock, users - 1)
+            else:
+                del _context_locks[customer_id]
+        
+        return context
+    
+    async def _load_customer_purchase_history(
+        self,
+        db: AsyncSession,
+        customer_id: int,
+        session_factory: Optional[sessionmaker] = None
+    ) -> Dict[str, Any]:
+        """Build the purchase-history context from the database"""
+        # The queries only depend on customer_id, so run them concurrently on
+        # separate sessions when a factory is available
+        queries = (_CUSTOMER_QUERY, _CATEGORY_QUERY, _RECENT_PURCHASES_QUERY)
+        params = {"customer_id": customer_id}
+        if session_factory is not None:
+            customer_rows, category_rows, recent_rows = await asyncio.gather(
+                *(run_in_session(session_factory, _fetch_rows, query, params) for query in queries)
+            )
+        else:
+            customer_rows, category_rows, recent_rows = [
+                await _fetch_rows(db, query, params) for query in queries
+            ]
         
-        # Get customer's category preferences
-        category_counts = {}
-        total_spent = 0
+        if not customer_rows:
+            return {}
+        customer = customer_rows[0]
         
-        for order in orders:
-            category = order.product.category
-            category_counts[category] = category_counts.get(category, 0) + 1
-            total_spent += order.product.price * order.quantity
+        category_counts = {category: count for category, count, _ in category_rows}
+        total_orders = sum(category_counts.values())
+        total_spent = sum(spent for _, _, spent in category_rows)
         
-        # Get recently purchased products
         recent_purchases = [
             {
-                "product_id": order.product.id,
-                "product_name": order.product.name,
-                "category": order.product.category,
-                "purchase_date": order.purchase_date.isoformat()
+                "product_id": product_id,
+                "product_name": product_name,
+                "category": category,
+                "purchase_date": purchase_date.isoformat()
             }
-            for order in orders[:5]  # Last 5 purchases
+            for purchase_date, product_id, product_name, category in recent_rows
         ]
         
         return {
             "customer_id": customer.id,
             "customer_name": customer.name,
-            "total_orders": len(orders),
+            "total_orders": total_orders,
             "total_spent": total_spent,
             "category_preferences": category_counts,
             "recent_purchases": recent_purchases,
@@ -84,13 +347,9 @@ class RecommendationService:
         exclude_product_ids: List[int] = None
     ) -> List[Dict[str, Any]]:
         """Get available products for recommendation"""
-        query = select(Product)
-        
-        if exclude_product_ids:
-            query = query.where(Product.id.not_in(exclude_product_ids))
-        
-        result = await db.execute(query)
-        products = result.scalars().all()
+        # The catalogue is served from the product cache; exclusions are filtered here
+        products = await get_all_products(db)
+        excluded_ids = set(exclude_product_ids or ())
         
         return [
             {
@@ -101,6 +360,7 @@ class RecommendationService:
                 "description": product.description or ""
             }
             for product in products
+            if product.id not in excluded_ids
         ]
     
     async def get_similar_customers(
@@ -110,52 +370,19 @@ class RecommendationService:
         limit: int = 5
     ) -> List[Dict[str, Any]]:
         """Find customers with similar purchase patterns"""
-        # Get target customer's category preferences
-        target_orders = await db.execute(
-            select(Order.product_id, Product.category)
-            .join(Product, Order.product_id == Product.id)
-            .where(Order.customer_id == customer_id)
-        )
-        target_data = target_orders.fetchall()
-        target_categories = {row.category for row in target_data}
-        
-        if not target_categories:
-            return []
-        
-        # Find other customers who bought products in similar categories
-        # Using string_agg for SQLite compatibility instead of array_agg
-        from sqlalchemy import text
-        
+        # The category set is a subquery, so the whole similarity scan is one statement
         similar_customers_result = await db.execute(
-            text("""
-                SELECT 
-                    o.customer_id,
-                    COUNT(o.id) as shared_purchases,
-                    GROUP_CONCAT(p.category) as categories
-                FROM orders o 
-                JOIN products p ON o.product_id = p.id 
-                WHERE o.customer_id != :customer_id 
-                AND p.category IN :categories
-                GROUP BY o.customer_id 
-                ORDER BY COUNT(o.id) DESC 
-                LIMIT :limit
-            """),
-            {
-                "customer_id": customer_id,
-                "categories": tuple(target_categories),
-                "limit": limit
-            }
+            _SIMILAR_CUSTOMERS_QUERY,
+            {"customer_id": customer_id, "limit": limit}
         )
         
-        similar_customers = similar_customers_result.fetchall()
-        
         return [
             {
                 "customer_id": row.customer_id,
                 "shared_purchases": row.shared_purchases,
                 "categories": row.categories.split(',') if row.categories else []
             }
-            for row in similar_customers
+            for row in similar_customers_result
         ]
     
     async def get_similar_customers_purchases(
@@ -170,42 +397,33 @@ class RecommendationService:
         
         customer_ids = [c["customer_id"] for c in similar_customers]
         
-        orders_result = await db.execute(
-            select(Order, Product)
-            .join(Product, Order.product_id == Product.id)
-            .where(
-                Order.customer_id.in_(customer_ids),
-                Order.product_id.not_in(exclude_product_ids)
-            )
-            .order_by(Order.purchase_date.desc())
+        # Count purchases and distinct buyers per product in the database
+        stats_result = await db.execute(
+            _NEIGHBOUR_PURCHASES_QUERY,
+            {"customer_ids": customer_ids, "exclude_product_ids": exclude_product_ids}
         )
         
-        orders = orders_result.fetchall()
-        
-        # Aggregate by product
-        product_stats = {}
-        for order, product in orders:
-            if product.id not in product_stats:
-                product_stats[product.id] = {
-                    "product_id": product.id,
-                    "product_name": product.name,
-                    "category": product.category,
-                    "price": product.price,
-                    "description": product.description or "",
-                    "purchase_count": 0,
-                    "customer_count": set()
-                }
-            
-            product_stats[product.id]["purchase_count"] += 1
-            product_stats[product.id]["customer_count"].add(order.customer_id)
-        
-        # Convert to list and sort by popularity
-        recommendations = list(product_stats.values())
-        for rec in recommendations:
-            rec["customer_count"] = len(rec["customer_count"])
-        
-        recommendations.sort(key=lambda x: (x["purchase_count"], x["customer_count"]), reverse=True)
-        return recommendations[:10]  # Top 10 recommendations from similar customers
+        return [_collaborative_row_to_dict(row) for row in stats_result]
+    
+    async def get_collaborative_recommendations(
+        self,
+        db: AsyncSession,
+        customer_id: int,
+        exclude_product_ids: List[int],
+        similar_limit: int = 5
+    ) -> List[Dict[str, Any]]:
+        """Get what similar customers bought in a single query"""
+        # Same result as get_similar_customers + get_similar_customers_purchases,
+        # in one round trip
+        result = await db.execute(
+            _COLLABORATIVE_QUERY,
+            {
+                "customer_id": customer_id,
+                "limit": similar_limit,
+                "exclude_product_ids": exclude_product_ids
+            }
+        )
+        return [_collaborative_row_to_dict(row) for row in result]
     
     async def generate_llm_recommendations(
         self,
@@ -214,7 +432,7 @@ class RecommendationService:
         collaborative_recommendations: List[Dict[str, Any]]
     ) -> List[Dict[str, Any]]:
         """Generate recommendations using OpenAI LLM"""
-        if not self.is_configured():
+        if not self._configured:
             return []
         
         # Prepare context for LLM
@@ -224,80 +442,136 @@ class RecommendationService:
             collaborative_recommendations
         )
         
+        # Identical prompts get identical answers for the cache lifetime
+        cache_key = blake2b(f"{self.model}\n{prompt}".encode(), digest_size=16).hexdigest()
+        cached = _llm_response_cache.get(cache_key)
+        if cached is not None:
+            return cached
+        
+        # Requests that arrive while the same prompt is in flight wait on that call
+        task = self._inflight.get(cache_key)
+        if task is None:
+            task = asyncio.create_task(self._request_llm_recommendations(prompt))
+            self._inflight[cache_key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(cache_key, None))
+        
+        # Shield so one caller disconnecting does not cancel the call for the others
+        recommendations = await asyncio.shield(task)
+        
+        # Failures come back empty; only cache real answers so they are retried
+        if recommendations:
+            _llm_response_cache.set(cache_key, recommendations)
+        return recommendations
+    
+    async def _request_llm_recommendations(self, prompt: str) -> List[Dict[str, Any]]:
+        """Send one recommendation prompt to the LLM and parse its reply"""
         try:
-            # Make API call to OpenAI-compatible endpoint
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    f"{self.base_url}/chat/completions",
-                    headers={
-                        "Authorization": f"Bearer {self.api_key}",
-                        "Content-Type": "application/json"
-                    },
-                    json={
-                        "model": self.model,
-                        "messages": [
-                            {
-                                "role": "system",
-                                "content": "You are a product recommendation expert. Analyze customer purchase history and provide personalized product recommendations. Return recommendations in JSON format with product_id, reason, and confidence_score (0-100)."
-                            },
-                            {
-                                "role": "user",
-                                "content": prompt
-                            }
-                        ],
-                        "temperature": 0.7,
-                        "max_tokens": 1000
-                    },
-                    timeout=30.0
-                )
-            
-            response.raise_for_status()
-            result = response.json()
+            content, streamed_items = await self._stream_llm_content_with_retry(prompt)
             
-            # Parse LLM response
-            content = result["choices"][0]["message"]["content"]
+            # Items parsed while streaming need no second pass over the body
+            if streamed_items:
+                return self._format_llm_recommendations(streamed_items)
             
-            # Try to extract JSON from response
+            # Try to extract JSON from response, fenced or bare
             try:
-                # Look for JSON between ```json and ```
-                if "```json" in content:
-                    json_content = content.split("```json")[1].split("```")[0]
-                elif "```" in content:
-                    json_content = content.split("```")[1].split("```")[0]
-                else:
-                    json_content = content
-                
-                recommendations = json.loads(json_content)
+                recommendations = _json_loads(_extract_json_payload(content))
                 
                 # Validate and format recommendations
                 if isinstance(recommendations, list):
-                    return [
-                        {
-                            "product_id": rec.get("product_id"),
-                            "reason": rec.get("reason", ""),
-                            "confidence_score": min(100, max(0, rec.get("confidence_score", 50))),
-                            "source": "llm"
-                        }
-                        for rec in recommendations
-                        if rec.get("product_id")
-                    ]
+                    return self._format_llm_recommendations(recommendations)
                 elif isinstance(recommendations, dict):
-                    return [{
-                        "product_id": recommendations.get("product_id"),
-                        "reason": recommendations.get("reason", ""),
-                        "confidence_score": min(100, max(0, recommendations.get("confidence_score", 50))),
-                        "source": "llm"
-                    }]
+                    return self._format_llm_recommendations([recommendations])
+                return []
                 
-            except json.JSONDecodeError:
+            except orjson.JSONDecodeError:
                 # If JSON parsing fails, return empty list
                 return []
                 
-        except Exception as e:
+        except Exception:
             # Log error but don't fail the entire recommendation
-            print(f"LLM recommendation error: {e}")
+            logger.exception("LLM recommendation error")
             return []
     
+    async def _stream_llm_content_with_retry(self, prompt: str) -> Tuple[str, List[Any]]:
+        """Stream a completion, retrying transport errors and retryable statuses with backoff"""
+        for attempt in range(_LLM_MAX_ATTEMPTS):
+            try:
+                async with self._semaphore:
+                    return await self._stream_llm_content(prompt)
+            except (httpx.TransportError, httpx.HTTPStatusError) as e:
+                if attempt + 1 >= _LLM_MAX_ATTEMPTS or not _is_retryable(e):
+                    raise
+                delay = _retry_delay(attempt, e)
+                logger.warning(f"LLM recommendation call failed ({e!r}); retrying in {delay:.2f}s")
+                await asyncio.sleep(delay)
+    
+    async def _stream_llm_content(self, prompt: str) -> Tuple[str, List[Any]]:
+        """Stream a completion, returning its text and the array items parsed on the way"""
+        parser = _IncrementalObjectParser()
+        parts: List[str] = []
+        items: List[Any] = []
+        
+        # Make API call to OpenAI-compatible endpoint over the pooled client
+        async with self._get_client().stream(
+            "POST",
+            f"{self.base_url}/chat/completions",
+            headers={
+                "Authorization": f"Bearer {self.api_key}",
+                "Content-Type": "application/json"
+            },
+            json={
+                "model": self.model,
+                "messages": [
+                    {
+                        "role": "system",
+                        "content": "You are a product recommendation expert. Analyze customer purchase history and provide personalized product recommendations. Return recommendations in JSON format with product_id, reason, and confidence_score (0-100)."
+                    },
+                    {
+                        "role": "user",
+                        "content": prompt
+                    }
+                ],
+                "temperature": 0.7,
+                "max_tokens": 1000,
+                "stream": True
+            }
+        ) as response:
+            response.raise_for_status()
+            
+            async for line in response.aiter_lines():
+                # Server-sent events: one "data: {...}" line per delta
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                
+                choices = _json_loads(data).get("choices")
+                delta = choices[0].get("delta", {}).get("content") if choices else None
+                if not delta:
+                    continue
+                
+                parts.append(delta)
+                items.extend(parser.feed(delta))
+                if len(items) >= _LLM_MAX_RECOMMENDATIONS:
+                    # Enough recommendations; leaving the block closes the stream early
+                    break
+        
+        return "".join(parts), items
+    
+    def _format_llm_recommendations(self, recommendations: List[Any]) -> List[Dict[str, Any]]:
+        """Validate parsed LLM items and tag them with their source"""
+        return [
+            {
+                "product_id": rec.get("product_id"),
+                "reason": rec.get("reason", ""),
+                "confidence_score": min(100, max(0, rec.get("confidence_score", 50))),
+                "source": "llm"
+            }
+            for rec in recommendations
+            if isinstance(rec, dict) and rec.get("product_id")
+        ]
+    
     def _build_recommendation_prompt(
         self,
         customer_context: Dict[str, Any],
@@ -305,55 +579,31 @@ class RecommendationService:
         collaborative_recommendations: List[Dict[str, Any]]
     ) -> str:
         """Build prompt for LLM recommendation"""
-        
-        # Format customer context
-        customer_info = f"""
-Customer: {customer_context.get('customer_name', 'Unknown')}
-Total Orders: {customer_context.get('total_orders', 0)}
-Total Spent: ${customer_context.get('total_spent', 0):.2f}
-Favorite Categories: {', '.join([cat[0] for cat in customer_context.get('favorite_categories', [])])}
-Recent Purchases: {', '.join([p['product_name'] for p in customer_context.get('recent_purchases', [])[:3]])}
-"""
-        
-        # Format collaborative recommendations
-        collab_info = "\n".join([
-            f"- {rec['product_name']} (Category: {rec['category']}, Price: ${rec['price']:.2f}) - Bought by {rec['customer_count']} similar customers"
-            for rec in collaborative_recommendations[:5]
-        ])
-        
-        # Format available products
-        products_info = "\n".join([
-            f"- ID: {p['id']}, Name: {p['name']}, Category: {p['category']}, Price: ${p['price']:.2f}"
-            for p in available_products[:20]  # Limit to avoid token overflow
-        ])
-        
-        prompt = f"""
-Based on the following customer context, provide personalized product recommendations:
-
-{customer_info}
-
-Products bought by similar customers:
-{collab_info if collab_info else 'None'}
-
-Available products to recommend:
-{products_info}
-
-Please provide 3-5 product recommendations with reasons and confidence scores (0-100).
-Return your response as JSON with fields: product_id, reason, confidence_score.
-"""
-        
-        return prompt
+        collab_info = "\n".join(map(_format_collaborative_line, collaborative_recommendations[:5]))
+        # Limit to avoid token overflow
+        products_info = "\n".join(map(_format_product_line, available_products[:20]))
+        
+        return _RECOMMENDATION_PROMPT_TEMPLATE.format(
+            customer_name=customer_context.get('customer_name', 'Unknown'),
+            total_orders=customer_context.get('total_orders', 0),
+            total_spent=customer_context.get('total_spent', 0),
+            favorite_categories=', '.join([cat[0] for cat in customer_context.get('favorite_categories', [])]),
+            recent_purchases=', '.join([p['product_name'] for p in customer_context.get('recent_purchases', [])[:3]]),
+            collab_info=collab_info if collab_info else 'None',
+            products_info=products_info
+        )
     
     async def get_recommendations(
         self,
         db: AsyncSession,
         customer_id: int,
-        limit: int = 5
+        limit: int = 5,
+        session_factory: Optional[sessionmaker] = None
     ) -> List[Dict[str, Any]]:
         """Get product recommendations for a customer"""
         
         # Get customer context
-        customer_context = await self.get_customer_purchase_history(db, customer_id)
+        customer_context = await self.get_customer_purchase_history(db, customer_id, session_factory)
         
         if not customer_context:
             return []
@@ -361,14 +611,20 @@ Return your response as JSON with fields: product_id, reason, confidence_score.
         # Get products to exclude (already purchased)
         exclude_product_ids = [p['product_id'] for p in customer_context.get('recent_purchases', [])]
         
-        # Get available products
-        available_products = await self.get_available_products(db, exclude_product_ids)
-        
-        # Get collaborative filtering recommendations
-        similar_customers = await self.get_similar_customers(db, customer_id)
-        collaborative_recommendations = await self.get_similar_customers_purchases(
-            db, similar_customers, exclude_product_ids
-        )
+        # Available products and collaborative filtering are independent; fetch
+        # them concurrently on separate sessions when a factory is available
+        if session_factory is not None:
+            available_products, collaborative_recommendations = await asyncio.gather(
+                run_in_session(session_factory, self.get_available_products, exclude_product_ids),
+                run_in_session(
+                    session_factory, self.get_collaborative_recommendations, customer_id, exclude_product_ids
+                )
+            )
+        else:
+            available_products = await self.get_available_products(db, exclude_product_ids)
+            collaborative_recommendations = await self.get_collaborative_recommendations(
+                db, customer_id, exclude_product_ids
+            )
         
         # Get LLM recommendations
         llm_recommendations = await self.generate_llm_recommendations(
@@ -377,6 +633,22 @@ Return your response as JSON with fields: product_id, reason, confidence_score.
             collaborative_recommendations
         )
         
+        return self.rank_recommendations(
+            collaborative_recommendations,
+            llm_recommendations,
+            available_products,
+            limit
+        )
+    
+    def rank_recommendations(
+        self,
+        collaborative_recommendations: List[Dict[str, Any]],
+        llm_recommendations: List[Dict[str, Any]],
+        available_products: List[Dict[str, Any]],
+        limit: int = 5
+    ) -> List[Dict[str, Any]]:
+        """Combine collaborative and LLM recommendations into a ranked, de-duplicated list"""
+        
         # Combine and rank recommendations
         all_recommendations = []
         
@@ -393,9 +665,10 @@ Return your response as JSON with fields: product_id, reason, confidence_score.
             })
         
         # Add LLM recommendations
+        products_by_id = {p["id"]: p for p in available_products}
         for rec in llm_recommendations[:limit]:
             # Find product details
-            product = next((p for p in available_products if p["id"] == rec["product_id"]), None)
+            product = products_by_id.get(rec["product_id"])
             if product:
                 all_recommendations.append({
                     "product_id": product["id"],
@@ -410,9 +683,16 @@ Return your response as JSON with fields: product_id, reason, confidence_score.
         # Sort by confidence score and remove duplicates
         seen = set()
         unique_recommendations = []
-        for rec in sorted(all_recommendations, key=lambda x: x["confidence_score"], reverse=True):
+        # Each source contributes at most `limit` items, so the top 2*limit hold every candidate
+        for rec in heapq.nlargest(limit * 2, all_recommendations, key=lambda x: x["confidence_score"]):
             if rec["product_id"] not in seen:
                 seen.add(rec["product_id"])
                 unique_recommendations.append(rec)
         
         return unique_recommendations[:limit]
+
+
+@lru_cache
+def get_recommendation_service() -> RecommendationService:
+    """Dependency to provide a shared RecommendationService"""
+    return RecommendationService(max_concurrency=settings.llm_max_concurrency)
@@ -12,14 +12,14 @@ Usage:
 import asyncio
 import random
 import sys
-import json
+import orjson
 from datetime import datetime, timedelta
 from decimal import Decimal
 from typing import Optional
 
 from faker import Faker
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, func
+from sqlalchemy import insert, select, func
 
 from app.db.session import engine, AsyncSessionLocal
 from app.db.base import Base
@@ -34,6 +34,7 @@ class DataSeeder:
     def __init__(self, reset_db: bool = False, force_reset: bool = False):
         self.faker = Faker()
         self.faker.seed_instance(42)  # For reproducible data
+        self.random = random.Random(42)
         self.reset_db = reset_db
         self.force_reset = force_reset
         
@@ -49,13 +50,11 @@ class DataSeeder:
             )
             customers.append(customer)
         
+        # The flush batches the INSERTs with RETURNING, so IDs are populated
+        # without a refresh per row (the session does not expire on commit)
         db.add_all(customers)
         await db.commit()
         
-        # Refresh to get IDs
-        for customer in customers:
-            await db.refresh(customer)
-        
         print(f"✓ Created {len(customers)} customers")
         return customers
     
@@ -65,8 +64,8 @@ class DataSeeder:
         
         # Load products from JSON file
         try:
-            with open('products.json', 'r', encoding='utf-8') as f:
-                products_data = json.load(f)
+            with open('products.json', 'rb') as f:
+                products_data = orjson.loads(f.read())
         except FileNotFoundError:
             print("❌ products.json not found, using fallback data")
             products_data = self._get_fallback_products()
@@ -81,13 +80,11 @@ class DataSeeder:
             )
             products.append(product)
         
+        # The flush batches the INSERTs with RETURNING, so IDs are populated
+        # without a refresh per row (the session does not expire on commit)
         db.add_all(products)
         await db.commit()
         
-        # Refresh to get IDs
-        for product in products:
-            await db.refresh(product)
-        
         print(f"✓ Created {len(products)} products from products.json")
         return products
     
@@ -120,28 +117,36 @@ class DataSeeder:
             }
         ]
     
-    async def create_orders(self, db: AsyncSession, customers: list[Customer], products: list[Product], orders_per_customer: int = 5) -> list[Order]:
+    async def create_orders(self, db: AsyncSession, customers: list[Customer], products: list[Product], orders_per_customer: int = 5) -> list[dict]:
         """Create sample orders for each customer"""
         print(f"Creating {orders_per_customer} orders per customer...")
         
-        orders = []
         current_time = datetime.utcnow()
+        count = len(customers) * orders_per_customer
         
-        for customer in customers:
-            for _ in range(orders_per_customer):
-                # Random date in the last 6 months
-                days_ago = random.randint(1, 180)
-                purchase_date = current_time - timedelta(days=days_ago)
-                
-                order = Order(
-                    customer_id=customer.id,
-                    product_id=random.choice(products).id,
-                    quantity=random.randint(1, 3),
-                    purchase_date=purchase_date
-                )
-                orders.append(order)
+        # Draw every random field up front in one call each instead of per row
+        product_ids = self.random.choices([product.id for product in products], k=count)
+        quantities = self.random.choices(range(1, 4), k=count)
+        purchase_dates = [
+            current_time - timedelta(days=days_ago)  # Random date in the last 6 months
+            for days_ago in self.random.choices(range(1, 181), k=count)
+        ]
+        customer_ids = [customer.id for customer in customers for _ in range(orders_per_customer)]
+        
+        # Plain rows skip building ORM objects
+        orders = [
+            {
+                "customer_id": customer_id,
+                "product_id": product_id,
+                "quantity": quantity,
+                "purchase_date": purchase_date
+            }
+            for customer_id, product_id, quantity, purchase_date
+            in zip(customer_ids, product_ids, quantities, purchase_dates)
+        ]
         
-        db.add_all(orders)
+        # A list of parameter sets runs as one multi-row INSERT per batch
+        await db.execute(insert(Order), orders)
         await db.commit()
         
         print(f"✓ Created {len(orders)} orders")
@@ -1,21 +1,52 @@
-import pytest
+import os
+
+# Point the app's own engine (used only by the lifespan) at memory before the app is
+# imported; each pytest-xdist worker is a separate process, so workers never share a database
+os.environ["DATABASE_URL"] = "sqlite+aiosqlite:///:memory:"
+
 import asyncio
-from typing import Generator
+import pytest
+import httpx
+import json
+from contextlib import contextmanager
+from types import MappingProxyType, SimpleNamespace
+from typing import AsyncIterator, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+from sqlalchemy import delete, event, func, select
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
 from sqlalchemy.pool import StaticPool
-from fastapi.testclient import TestClient
 
+try:
+    import uvloop
+except ImportError:  # uvloop comes with uvicorn[standard], which skips it on Windows
+    uvloop = None
+
+from app.core.config import settings
 from app.db.base import Base
-from app.db.session import get_db, AsyncSessionLocal
+from app.db.session import get_db, get_session_factory, set_sqlite_pragmas, AsyncSessionLocal
 from app.main import app
+from app.api.v1.ai_recommendations import _response_cache
+from app.services.ai_service import get_ai_service, get_openai_client, get_recommendation_batcher
+from app.services.product import _product_cache
+from app.services.customer import create_customer
+from app.services.product import create_product
+from app.services.recommendation import _context_cache, _llm_response_cache, get_recommendation_service
+from app.models.customer import Customer
+from app.models.order import Order
+from app.models.product import Product
+from app.schemas.customer import CustomerCreate
+from app.schemas.order import OrderCreate
+from app.schemas.product import ProductCreate
 
 
-# In-memory SQLite engine for testing
+# In-memory SQLite engine for testing; StaticPool hands the app and the tests the
+# same single connection, so everything sees one database without disk I/O
 test_engine = create_async_engine(
     "sqlite+aiosqlite:///:memory:",
     echo=False,
-    poolclass=StaticPool
+    poolclass=StaticPool,
+    connect_args={"check_same_thread": False}
 )
+event.listen(test_engine.sync_engine, "connect", set_sqlite_pragmas)
 
 # Create async session factory for testing
 TestAsyncSessionLocal = async_sessionmaker(
@@ -34,69 +65,321 @@ async def override_get_db():
             await session.close()
 
 
-# Override the dependency in the FastAPI app
+async def override_get_session_factory():
+    """Override get_session_factory dependency for testing"""
+    return TestAsyncSessionLocal
+
+
+# Override the dependencies in the FastAPI app
 app.dependency_overrides[get_db] = override_get_db
+app.dependency_overrides[get_session_factory] = override_get_session_factory
 
 
-@pytest.fixture(scope="session")
-def event_loop() -> Generator:
-    """Create an instance of the default event loop for the test session."""
-    loop = asyncio.get_event_loop_policy().new_event_loop()
-    yield loop
-    loop.close()
+def completion_chunks(content: str, chunk_size: int = 16) -> Tuple[SimpleNamespace, ...]:
+    """Build the chunks of a streamed chat completion carrying content in small deltas"""
+    return tuple(
+        SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=content[start:start + chunk_size]))])
+        for start in range(0, len(content), chunk_size)
+    )
+
+
+async def replay_completion_stream(chunks: Iterable[SimpleNamespace]) -> AsyncIterator[SimpleNamespace]:
+    """Replay prebuilt completion chunks as a fresh stream"""
+    for chunk in chunks:
+        yield chunk
+
+
+def sse_completion_body(content: str, chunk_size: int = 16) -> str:
+    """Fake the server-sent events body of a streamed chat completion"""
+    events = [
+        "data: " + json.dumps({"choices": [{"delta": {"content": content[start:start + chunk_size]}}]})
+        for start in range(0, len(content), chunk_size)
+    ]
+    return "\n\n".join(events + ["data: [DONE]"]) + "\n\n"
+
+
+# Streamed response chunks are built once; each call replays them as a fresh stream
+MOCK_AI_RECOMMENDATION = {
+    "item": "Mocked Recommendation",
+    "reason": "This is a mocked recommendation for testing",
+    "confidence": 85
+}
+MOCK_AI_CHUNKS = completion_chunks(json.dumps([MOCK_AI_RECOMMENDATION]))
+
+# Settings under which AIService considers itself configured
+MOCK_AI_SETTINGS = {
+    "llm_api_key": "test-key",
+    "llm_base_url": "https://api.openai.com/v1",
+    "llm_model": "gpt-3.5-turbo"
+}
+
+
+class FakeOpenAIClient:
+    """AsyncOpenAI stand-in exposing only chat.completions.create, which records each call"""
+    
+    def __init__(self, chunks: Sequence[SimpleNamespace] = (), error: Optional[Exception] = None, api_key: Optional[str] = "test-key"):
+        self.api_key = api_key
+        self.chunks = tuple(chunks)
+        self.error = error
+        self.calls: List[Dict] = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+    
+    async def _create(self, **kwargs):
+        self.calls.append(kwargs)
+        if self.error is not None:
+            raise self.error
+        return replay_completion_stream(self.chunks)
+    
+    def reset(self) -> None:
+        """Forget recorded calls and go back to an empty stream"""
+        self.chunks = ()
+        self.error = None
+        self.calls.clear()
 
 
 @pytest.fixture
-async def db_session():
-    """Create a fresh database session for each test."""
-    # Create tables
+def llm_settings(monkeypatch):
+    """Configure the LLM on the real settings object for one test; undone at teardown."""
+    for name, value in MOCK_AI_SETTINGS.items():
+        monkeypatch.setattr(settings, name, value)
+    return settings
+
+
+def mock_ai_success(client: FakeOpenAIClient) -> None:
+    """Make the fake client stream a single recommendation"""
+    client.chunks = MOCK_AI_CHUNKS
+    client.error = None
+
+
+def mock_ai_failure(client: FakeOpenAIClient) -> None:
+    """Make the fake client raise on every call"""
+    client.error = Exception("AI API Error")
+
+
+# One AsyncOpenAI stand-in for the whole session, injected in place of the real client;
+# tests only reconfigure its canned response
+shared_openai_client = FakeOpenAIClient()
+app.dependency_overrides[get_openai_client] = lambda: shared_openai_client
+
+
+@contextmanager
+def count_queries() -> Iterator[List[str]]:
+    """Collect the SELECT statements the test engine executes while the block runs"""
+    statements: List[str] = []
+    
+    def record(conn, cursor, statement, parameters, context, executemany):
+        # SAVEPOINT bookkeeping from the rollback fixtures is not a query
+        if statement.lstrip().upper().startswith("SELECT"):
+            statements.append(statement)
+    
+    event.listen(test_engine.sync_engine, "before_cursor_execute", record)
+    try:
+        yield statements
+    finally:
+        event.remove(test_engine.sync_engine, "before_cursor_execute", record)
+
+
+def pytest_asyncio_loop_factories(config, item):
+    """Run the session event loop on uvloop, as the server does, when it is installed."""
+    if uvloop is not None:
+        return {"uvloop": uvloop.new_event_loop}
+    return {"asyncio": asyncio.new_event_loop}
+
+
+# Fixtures that open or hold a test database connection
+_DB_FIXTURES = frozenset({"db_connection", "db_session", "seed_customer_product", "client", "app_client"})
+
+
+def pytest_collection_modifyitems(config, items):
+    """Reject tests marked no_db that request database fixtures, before any connection is opened."""
+    for item in items:
+        if item.get_closest_marker("no_db") is None:
+            continue
+        requested = _DB_FIXTURES.intersection(item.fixturenames)
+        if requested:
+            raise pytest.UsageError(f"{item.nodeid} is marked no_db but requests {', '.join(sorted(requested))}")
+
+
+@pytest.fixture(scope="session")
+async def test_schema():
+    """Create the schema once per test session."""
     async with test_engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
-    
-    # Create session
-    async with TestAsyncSessionLocal() as session:
+
+
+@pytest.fixture(scope="module")
+async def db_connection(test_schema):
+    """One connection per test module inside a transaction that is rolled back at module end."""
+    async with test_engine.connect() as conn:
+        transaction = await conn.begin()
+        
+        # Start from empty tables; the rollback restores anything seeded for other tests
+        for table in reversed(Base.metadata.sorted_tables):
+            await conn.execute(delete(table))
+        
         try:
-            yield session
+            yield conn
         finally:
-            await session.close()
+            await transaction.rollback()
+
+
+def savepoint_session(conn) -> AsyncSession:
+    """Session whose commits only release a SAVEPOINT on the given connection"""
+    return AsyncSession(
+        bind=conn,
+        expire_on_commit=False,
+        join_transaction_mode="create_savepoint"
+    )
+
+
+@pytest.fixture
+async def db_session(db_connection):
+    """Session inside a SAVEPOINT that is rolled back after each test."""
+    # Ids are reused across tests, so cached products must not leak
+    _product_cache.clear()
+    _context_cache.clear()
     
-    # Drop tables after test
+    savepoint = await db_connection.begin_nested()
+    session = savepoint_session(db_connection)
+    try:
+        yield session
+    finally:
+        await session.close()
+        await savepoint.rollback()
+
+
+# Rows shared by API tests; the email differs from test_customer_data so tests
+# that create their own customer do not collide with the seed
+SEED_CUSTOMER_DATA = {
+    "name": "Seeded Customer",
+    "email": "seeded.customer@example.com"
+}
+SEED_PRODUCT_DATA = {
+    "name": "Test Product",
+    "category": "Electronics",
+    "price": 99.99,
+    "description": "A test product"
+}
+
+
+async def bulk_seed(
+    session: AsyncSession,
+    customers: Sequence[CustomerCreate] = (),
+    products: Sequence[ProductCreate] = (),
+    orders: Sequence[OrderCreate] = ()
+) -> List[Base]:
+    """Insert rows with one flush and one commit; returns the new objects in insertion order"""
+    rows = (
+        [Customer(**customer.model_dump()) for customer in customers]
+        + [Product(**product.model_dump()) for product in products]
+        + [Order(**order.model_dump()) for order in orders]
+    )
+    session.add_all(rows)
+    await session.commit()
+    return rows
+
+
+@pytest.fixture(scope="class")
+async def seed_customer_product(db_connection):
+    """Customer and product created once per test class, in a SAVEPOINT rolled back after it."""
+    savepoint = await db_connection.begin_nested()
+    async with savepoint_session(db_connection) as session:
+        customer, product = await bulk_seed(
+            session,
+            customers=[CustomerCreate.model_construct(**SEED_CUSTOMER_DATA)],
+            products=[ProductCreate.model_construct(**SEED_PRODUCT_DATA)]
+        )
+    
+    try:
+        yield customer, product
+    finally:
+        await savepoint.rollback()
+
+
+async def restore_seed(watermarks: Dict[str, int]) -> None:
+    """Delete every row created after seeding, leaving the seeded rows in place"""
     async with test_engine.begin() as conn:
-        await conn.run_sync(Base.metadata.drop_all)
+        for table in reversed(Base.metadata.sorted_tables):
+            await conn.execute(delete(table).where(table.c.id > watermarks.get(table.name, 0)))
 
 
-@pytest.fixture
-def client():
-    """Create a test client for the FastAPI app."""
-    with TestClient(app) as test_client:
-        yield test_client
+@pytest.fixture(scope="session")
+async def seed_watermarks(test_schema):
+    """Seed rows once per session; returns the highest id per table."""
+    async with TestAsyncSessionLocal() as session:
+        await create_customer(session, CustomerCreate.model_construct(**SEED_CUSTOMER_DATA))
+        await create_product(session, ProductCreate.model_construct(**SEED_PRODUCT_DATA))
+        return {
+            table.name: (await session.execute(select(func.coalesce(func.max(table.c.id), 0)))).scalar_one()
+            for table in Base.metadata.sorted_tables
+        }
 
 
 @pytest.fixture
-async def test_customer_data():
-    """Sample customer data for testing."""
+def seeded_ids(seed_watermarks: Dict[str, int]):
+    """Ids of the session-wide seeded customer and product."""
     return {
-        "name": "John Doe",
-        "email": "john.doe@example.com"
+        "customer_id": seed_watermarks["customers"],
+        "product_id": seed_watermarks["products"]
     }
 
 
+@pytest.fixture(scope="session")
+async def app_client(seed_watermarks):
+    """One ASGI client for the whole session; the app lifespan runs once around it."""
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+            transport=transport,
+            base_url="http://test",
+            follow_redirects=True
+        ) as test_client:
+            yield test_client
+
+
 @pytest.fixture
-async def test_product_data():
-    """Sample product data for testing."""
-    return {
+async def client(app_client: httpx.AsyncClient, seed_watermarks: Dict[str, int]):
+    """The shared client with per-test state reset; rows a test adds are removed afterwards."""
+    # Drop cached services so per-test settings take effect, and forget earlier AI calls
+    shared_openai_client.reset()
+    get_ai_service.cache_clear()
+    get_recommendation_batcher.cache_clear()
+    get_recommendation_service.cache_clear()
+    _response_cache.clear()
+    _product_cache.clear()
+    _context_cache.clear()
+    _llm_response_cache.clear()
+    
+    yield app_client
+    
+    await restore_seed(seed_watermarks)
+
+
+@pytest.fixture(scope="session")
+def test_customer_data():
+    """Sample customer data for testing; read-only, so one instance serves the session."""
+    return MappingProxyType({
+        "name": "John Doe",
+        "email": "john.doe@example.com"
+    })
+
+
+@pytest.fixture(scope="session")
+def test_product_data():
+    """Sample product data for testing; read-only, so one instance serves the session."""
+    return MappingProxyType({
         "name": "Test Product",
         "category": "Electronics",
         "price": 99.99,
         "description": "A test product"
-    }
+    })
 
 
-@pytest.fixture
-async def test_order_data():
-    """Sample order data for testing."""
-    return {
+@pytest.fixture(scope="session")
+def test_order_data():
+    """Sample order data for testing; read-only, so one instance serves the session."""
+    return MappingProxyType({
         "customer_id": 1,
         "product_id": 1,
         "quantity": 2
-    }
+    })
@@ -0,0 +1,68 @@
+import pytest
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.models.customer import Customer
+from app.models.order import Order
+from app.models.product import Product
+from app.services.ai_service import AIService
+from app.services.order import get_purchase_history_by_customer
+from tests.conftest import (
+    MOCK_AI_RECOMMENDATION,
+    FakeOpenAIClient,
+    mock_ai_failure,
+    mock_ai_success,
+)
+
+
+@pytest.fixture
+async def customer(db_session: AsyncSession) -> Customer:
+    """A customer with one purchased product, staged in a single flush."""
+    customer = Customer(name="John Doe", email="john.doe@example.com")
+    product = Product(name="Test Product", category="Electronics", price=99.99)
+    db_session.add_all([customer, product])
+    await db_session.flush()
+    
+    db_session.add(Order(customer_id=customer.id, product_id=product.id, quantity=2))
+    await db_session.commit()
+    return customer
+
+
+class TestAIRecommendationFlow:
+    """Service-level cases behind POST /customers/{id}/recommendations, without HTTP."""
+    
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize(
+        "ai_mock,expected_item",
+        [
+            (None, None),
+            (mock_ai_success, MOCK_AI_RECOMMENDATION["item"]),
+            (mock_ai_failure, None),
+        ],
+        ids=["no_ai_config", "mocked_ai", "ai_api_failure"],
+    )
+    async def test_recommendations_from_history(self, db_session: AsyncSession, customer: Customer, llm_settings, ai_mock, expected_item):
+        """Test the AI service answers a stored purchase history under each AsyncOpenAI behaviour."""
+        purchase_history = await get_purchase_history_by_customer(db_session, customer.id)
+        assert purchase_history == ["Test Product (Category: Electronics)"]
+        
+        # No injected client means the AI is not configured
+        client = None
+        if ai_mock is not None:
+            client = FakeOpenAIClient()
+            ai_mock(client)
+        
+        ai_service = AIService(client)
+        recommendations = await ai_service.get_recommendations(purchase_history)
+        
+        assert len(recommendations) > 0
+        for rec in recommendations:
+            assert isinstance(rec["item"], str)
+            assert isinstance(rec["reason"], str)
+            assert isinstance(rec["confidence"], int)
+            assert 0 <= rec["confidence"] <= 100
+        
+        if expected_item is None:
+            # Unconfigured and failing clients both fall back to rule-based picks
+            assert MOCK_AI_RECOMMENDATION not in recommendations
+        else:
+            assert recommendations == [MOCK_AI_RECOMMENDATION]
@@ -1,18 +1,18 @@
-import pytest
+import httpx
 import json
-from unittest.mock import AsyncMock, patch
+import pytest
+from typing import Mapping
 
-from tests.conftest import test_customer_data, test_product_data, test_order_data
-from fastapi.testclient import TestClient
+from tests.conftest import MOCK_AI_RECOMMENDATION, SEED_PRODUCT_DATA, mock_ai_failure, mock_ai_success, shared_openai_client
 
 
 class TestCustomerAPI:
     """Test cases for customer-related API endpoints."""
     
     @pytest.mark.asyncio
-    async def test_create_customer(self, client: TestClient, test_customer_data: dict):
+    async def test_create_customer(self, client: httpx.AsyncClient, test_customer_data: Mapping):
         """Test creating a new customer."""
-        response = await client.post("/customers", json=test_customer_data)
+        response = await client.post("/customers", json=dict(test_customer_data))
         
         assert response.status_code == 201
         data = response.json()
@@ -23,14 +23,13 @@ class TestCustomerAPI:
         assert "created_at" in data
     
     @pytest.mark.asyncio
-    async def test_create_customer_duplicate_email(self, client: TestClient, test_customer_data: dict):
+    async def test_create_customer_duplicate_email(self, client: httpx.AsyncClient, test_customer_data: Mapping):
         """Test creating a customer with duplicate email should fail."""
         # Create first customer
-        await client.post("/customers", json=test_customer_data)
+        await client.post("/customers", json=dict(test_customer_data))
         
         # Try to create another with same email
-        duplicate_data = test_customer_data.copy()
-        duplicate_data["name"] = "Jane Doe"
+        duplicate_data = {**test_customer_data, "name": "Jane Doe"}
         
         response = await client.post("/customers", json=duplicate_data)
         
@@ -38,10 +37,23 @@ class TestCustomerAPI:
         assert response.status_code == 500
     
     @pytest.mark.asyncio
-    async def test_get_customer_history_empty(self, client: TestClient, test_customer_data: dict):
+    async def test_list_customers_streams_ndjson(self, client: httpx.AsyncClient, seeded_ids: dict, test_customer_data: Mapping):
+        """Test all customers are streamed one JSON object per line in id order."""
+        created = (await client.post("/customers", json=dict(test_customer_data))).json()
+        
+        response = await client.get("/customers")
+        
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/x-ndjson"
+        customers = [json.loads(line) for line in response.text.splitlines()]
+        assert [customer["id"] for customer in customers] == [seeded_ids["customer_id"], created["id"]]
+        assert customers[-1]["email"] == test_customer_data["email"]
+    
+    @pytest.mark.asyncio
+    async def test_get_customer_history_empty(self, client: httpx.AsyncClient, test_customer_data: Mapping):
         """Test getting customer history when no orders exist."""
         # Create customer
-        create_response = await client.post("/customers", json=test_customer_data)
+        create_response = await client.post("/customers", json=dict(test_customer_data))
         customer_id = create_response.json()["id"]
         
         # Get customer history
@@ -56,20 +68,14 @@ class TestCustomerAPI:
         assert data["orders"] == []
     
     @pytest.mark.asyncio
-    async def test_get_customer_history_with_orders(self, client: TestClient, test_customer_data: dict, test_product_data: dict, test_order_data: dict):
+    async def test_get_customer_history_with_orders(self, client: httpx.AsyncClient, seeded_ids: dict, test_order_data: Mapping):
         """Test getting customer history with existing orders."""
-        # Create customer
-        create_customer_response = await client.post("/customers", json=test_customer_data)
-        customer_id = create_customer_response.json()["id"]
-        
-        # Create product
-        create_product_response = await client.post("/products", json=test_product_data)
-        product_id = create_product_response.json()["id"]
+        # Customer and product are seeded once per session
+        customer_id = seeded_ids["customer_id"]
+        product_id = seeded_ids["product_id"]
         
         # Update order data with actual IDs
-        order_data = test_order_data.copy()
-        order_data["customer_id"] = customer_id
-        order_data["product_id"] = product_id
+        order_data = {**test_order_data, "customer_id": customer_id, "product_id": product_id}
         
         # Create order
         create_order_response = await client.post("/orders", json=order_data)
@@ -89,28 +95,48 @@ class TestCustomerAPI:
         assert order["product_id"] == product_id
         assert order["quantity"] == order_data["quantity"]
         assert "product" in order
-        assert order["product"]["name"] == test_product_data["name"]
-        assert order["product"]["category"] == test_product_data["category"]
+        assert order["product"]["name"] == SEED_PRODUCT_DATA["name"]
+        assert order["product"]["category"] == SEED_PRODUCT_DATA["category"]
+    
+    @pytest.mark.asyncio
+    async def test_get_customer_orders_pages_with_after_id(self, client: httpx.AsyncClient, seeded_ids: dict, test_order_data: Mapping):
+        """Test a customer's orders are paged with the after_id cursor."""
+        customer_id = seeded_ids["customer_id"]
+        for quantity in (1, 2, 3):
+            await client.post("/orders", json={**test_order_data, "customer_id": customer_id, "product_id": seeded_ids["product_id"], "quantity": quantity})
+        
+        first_page = (await client.get(f"/customers/{customer_id}/orders", params={"limit": 2})).json()
+        second_page = (await client.get(f"/customers/{customer_id}/orders", params={"limit": 2, "after_id": first_page[-1]["id"]})).json()
+        
+        assert [order["quantity"] for order in first_page] == [1, 2]
+        assert [order["quantity"] for order in second_page] == [3]
+    
+    @pytest.mark.asyncio
+    async def test_get_customer_orders_empty_and_unknown(self, client: httpx.AsyncClient, seeded_ids: dict):
+        """Test a customer without orders gets an empty page and an unknown customer gets 404."""
+        response = await client.get(f"/customers/{seeded_ids['customer_id']}/orders")
+        
+        assert response.status_code == 200
+        assert response.json() == []
+        
+        response = await client.get("/customers/999/orders")
+        
+        assert response.status_code == 404
+        assert response.json()["detail"] == "Customer not found"
 
 
 class TestOrderAPI:
     """Test cases for order-related API endpoints."""
     
     @pytest.mark.asyncio
-    async def test_create_order(self, client: TestClient, test_customer_data: dict, test_product_data: dict, test_order_data: dict):
+    async def test_create_order(self, client: httpx.AsyncClient, seeded_ids: dict, test_order_data: Mapping):
         """Test creating a new order."""
-        # Create customer
-        create_customer_response = await client.post("/customers", json=test_customer_data)
-        customer_id = create_customer_response.json()["id"]
-        
-        # Create product
-        create_product_response = await client.post("/products", json=test_product_data)
-        product_id = create_product_response.json()["id"]
+        # Customer and product are seeded once per session
+        customer_id = seeded_ids["customer_id"]
+        product_id = seeded_ids["product_id"]
         
         # Update order data with actual IDs
-        order_data = test_order_data.copy()
-        order_data["customer_id"] = customer_id
-        order_data["product_id"] = product_id
+        order_data = {**test_order_data, "customer_id": customer_id, "product_id": product_id}
         
         # Create order
         response = await client.post("/orders", json=order_data)
@@ -125,10 +151,10 @@ class TestOrderAPI:
         assert "purchase_date" in data
     
     @pytest.mark.asyncio
-    async def test_create_order_invalid_customer(self, client: TestClient, test_order_data: dict):
+    async def test_create_order_invalid_customer(self, client: httpx.AsyncClient, test_order_data: Mapping):
         """Test creating an order with invalid customer ID."""
-        order_data = test_order_data.copy()
-        order_data["customer_id"] = 999  # Non-existent customer
+        # Non-existent customer
+        order_data = {**test_order_data, "customer_id": 999}
         
         response = await client.post("/orders", json=order_data)
         
@@ -136,16 +162,10 @@ class TestOrderAPI:
         assert "Customer not found" in response.json()["detail"]
     
     @pytest.mark.asyncio
-    async def test_create_order_invalid_product(self, client: TestClient, test_customer_data: dict, test_order_data: dict):
+    async def test_create_order_invalid_product(self, client: httpx.AsyncClient, seeded_ids: dict, test_order_data: Mapping):
         """Test creating an order with invalid product ID."""
-        # Create customer
-        create_customer_response = await client.post("/customers", json=test_customer_data)
-        customer_id = create_customer_response.json()["id"]
-        
-        # Update order data
-        order_data = test_order_data.copy()
-        order_data["customer_id"] = customer_id
-        order_data["product_id"] = 999  # Non-existent product
+        # Update order data with a non-existent product
+        order_data = {**test_order_data, "customer_id": seeded_ids["customer_id"], "product_id": 999}
         
         response = await client.post("/orders", json=order_data)
         
@@ -153,19 +173,28 @@ class TestOrderAPI:
         assert "Product not found" in response.json()["detail"]
     
     @pytest.mark.asyncio
-    async def test_get_order_by_id(self, client: TestClient, test_customer_data: dict, test_product_data: dict, test_order_data: dict):
-        """Test getting an order by ID."""
-        # Create customer and product
-        create_customer_response = await client.post("/customers", json=test_customer_data)
-        customer_id = create_customer_response.json()["id"]
+    async def test_list_orders_streams_ndjson(self, client: httpx.AsyncClient, seeded_ids: dict, test_order_data: Mapping):
+        """Test all orders are streamed one JSON object per line with their products."""
+        order_data = {**test_order_data, "customer_id": seeded_ids["customer_id"], "product_id": seeded_ids["product_id"]}
+        created_ids = [(await client.post("/orders", json=order_data)).json()["id"] for _ in range(2)]
         
-        create_product_response = await client.post("/products", json=test_product_data)
-        product_id = create_product_response.json()["id"]
+        response = await client.get("/orders")
+        
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/x-ndjson"
+        orders = [json.loads(line) for line in response.text.splitlines()]
+        assert [order["id"] for order in orders] == created_ids
+        assert all(order["product"]["name"] == SEED_PRODUCT_DATA["name"] for order in orders)
+    
+    @pytest.mark.asyncio
+    async def test_get_order_by_id(self, client: httpx.AsyncClient, seeded_ids: dict, test_order_data: Mapping):
+        """Test getting an order by ID."""
+        # Customer and product are seeded once per session
+        customer_id = seeded_ids["customer_id"]
+        product_id = seeded_ids["product_id"]
         
         # Create order
-        order_data = test_order_data.copy()
-        order_data["customer_id"] = customer_id
-        order_data["product_id"] = product_id
+        order_data = {**test_order_data, "customer_id": customer_id, "product_id": product_id}
         
         create_order_response = await client.post("/orders", json=order_data)
         order_id = create_order_response.json()["id"]
@@ -181,160 +210,119 @@ class TestOrderAPI:
         assert data["product_id"] == product_id
         assert data["quantity"] == order_data["quantity"]
         assert "product" in data
-        assert data["product"]["name"] == test_product_data["name"]
+        assert data["product"]["name"] == SEED_PRODUCT_DATA["name"]
 
 
 class TestAIRecommendationsAPI:
-    """Test cases for AI recommendation API endpoints."""
+    """Test cases for the AI recommendation endpoint; service-level variants live in test_ai_service.py."""
     
     @pytest.mark.asyncio
-    async def test_get_ai_recommendations_no_history(self, client: TestClient, test_customer_data: dict):
-        """Test getting AI recommendations for customer with no purchase history."""
-        # Create customer
-        create_customer_response = await client.post("/customers", json=test_customer_data)
-        customer_id = create_customer_response.json()["id"]
-        
-        # Get recommendations
-        response = await client.post(f"/customers/{customer_id}/recommendations")
+    async def test_get_ai_recommendations_nonexistent_customer(self, client: httpx.AsyncClient):
+        """Test AI recommendations for an unknown customer return 404."""
+        response = await client.post("/customers/999/recommendations")
         
-        assert response.status_code == 503
-        assert "No purchase history found" in response.json()["detail"]
+        assert response.status_code == 404
+        assert response.json()["detail"] == "Customer not found"
     
     @pytest.mark.asyncio
-    async def test_get_ai_recommendations_with_history_no_ai_config(self, client: TestClient, test_customer_data: dict, test_product_data: dict, test_order_data: dict):
-        """Test getting AI recommendations with purchase history but no AI configuration (fallback mode)."""
-        # Create customer and product
-        create_customer_response = await client.post("/customers", json=test_customer_data)
-        customer_id = create_customer_response.json()["id"]
+    async def test_get_ai_recommendations_no_history(self, client: httpx.AsyncClient, seeded_ids: dict):
+        """Test AI recommendations for a customer without orders return 404."""
+        response = await client.post(f"/customers/{seeded_ids['customer_id']}/recommendations")
         
-        create_product_response = await client.post("/products", json=test_product_data)
-        product_id = create_product_response.json()["id"]
+        assert response.status_code == 404
+        assert response.json()["detail"] == "No purchase history found for this customer"
+    
+    @pytest.mark.slow
+    @pytest.mark.asyncio
+    async def test_get_ai_recommendations_with_mocked_ai(self, client: httpx.AsyncClient, seeded_ids: dict, test_order_data: Mapping, llm_settings):
+        """Test getting AI recommendations through the full stack with the injected AsyncOpenAI mock."""
+        # Customer and product are seeded once per session
+        customer_id = seeded_ids["customer_id"]
         
         # Create order (purchase history)
-        order_data = test_order_data.copy()
-        order_data["customer_id"] = customer_id
-        order_data["product_id"] = product_id
+        order_data = {**test_order_data, "customer_id": customer_id, "product_id": seeded_ids["product_id"]}
         
         await client.post("/orders", json=order_data)
         
-        # Get recommendations (should use fallback since AI is not configured)
+        # The injected client streams the mocked recommendation
+        mock_ai_success(shared_openai_client)
+        
+        # Get recommendations
         response = await client.post(f"/customers/{customer_id}/recommendations")
         
         assert response.status_code == 200
         data = response.json()
         
         assert data["customer_id"] == customer_id
-        assert len(data["recommendations"]) > 0
-        assert data["total_recommendations"] == len(data["recommendations"])
+        assert data["total_recommendations"] == 1
         assert data["source"] == "ai"
-        
-        # Check recommendation structure
-        for rec in data["recommendations"]:
-            assert "item" in rec
-            assert "reason" in rec
-            assert "confidence" in rec
-            assert isinstance(rec["item"], str)
-            assert isinstance(rec["reason"], str)
-            assert isinstance(rec["confidence"], int)
-            assert 0 <= rec["confidence"] <= 100
+        assert data["recommendations"] == [MOCK_AI_RECOMMENDATION]
+    
+    @pytest.mark.asyncio
+    async def test_repeat_request_revalidates_with_etag(self, client: httpx.AsyncClient, seeded_ids: dict, test_order_data: Mapping, llm_settings):
+        """Test a cached LLM answer is revalidated by ETag without another LLM call."""
+        customer_id = seeded_ids["customer_id"]
+        await client.post("/orders", json={**test_order_data, "customer_id": customer_id, "product_id": seeded_ids["product_id"]})
+        mock_ai_success(shared_openai_client)
+        
+        first = await client.post(f"/customers/{customer_id}/recommendations")
+        etag = first.headers["ETag"]
+        revalidated = await client.post(f"/customers/{customer_id}/recommendations", headers={"If-None-Match": etag})
+        
+        assert first.json()["source"] == "ai"
+        assert revalidated.status_code == 304
+        assert revalidated.headers["ETag"] == etag
+        assert len(shared_openai_client.calls) == 1
     
     @pytest.mark.asyncio
-    async def test_get_ai_recommendations_with_mocked_ai(self, client: TestClient, test_customer_data: dict, test_product_data: dict, test_order_data: dict):
-        """Test getting AI recommendations with mocked AsyncOpenAI call."""
-        # Create customer and product
-        create_customer_response = await client.post("/customers", json=test_customer_data)
-        customer_id = create_customer_response.json()["id"]
+    async def test_fallback_is_not_cached(self, client: httpx.AsyncClient, seeded_ids: dict, test_order_data: Mapping, llm_settings):
+        """Test a rule-based fallback after an LLM error is neither cached nor given an ETag."""
+        customer_id = seeded_ids["customer_id"]
+        await client.post("/orders", json={**test_order_data, "customer_id": customer_id, "product_id": seeded_ids["product_id"]})
+        mock_ai_failure(shared_openai_client)
         
-        create_product_response = await client.post("/products", json=test_product_data)
-        product_id = create_product_response.json()["id"]
+        fallback = await client.post(f"/customers/{customer_id}/recommendations")
         
-        # Create order (purchase history)
-        order_data = test_order_data.copy()
-        order_data["customer_id"] = customer_id
-        order_data["product_id"] = product_id
+        assert fallback.status_code == 200
+        assert fallback.json()["source"] == "fallback"
+        assert "ETag" not in fallback.headers
+        assert fallback.headers["Cache-Control"] == "no-store"
         
-        await client.post("/orders", json=order_data)
+        # Once the LLM recovers, the next request reaches it instead of a cached fallback
+        mock_ai_success(shared_openai_client)
+        recovered = await client.post(f"/customers/{customer_id}/recommendations")
         
-        # Mock AI response
-        mock_ai_response = [
-            {
-                "item": "Mocked Recommendation",
-                "reason": "This is a mocked recommendation for testing",
-                "confidence": 85
-            }
-        ]
-        
-        with patch('app.services.ai_service.AsyncOpenAI') as mock_openai:
-            # Set up the mock
-            mock_client = AsyncMock()
-            mock_openai.return_value = mock_client
-            
-            mock_response = AsyncMock()
-            mock_response.choices = [AsyncMock()]
-            mock_response.choices[0].message.content = json.dumps(mock_ai_response)
-            mock_client.chat.completions.create.return_value = mock_response
-            
-            # Get recommendations
-            response = await client.post(f"/customers/{customer_id}/recommendations")
-            
-            assert response.status_code == 200
-            data = response.json()
-            
-            assert data["customer_id"] == customer_id
-            assert len(data["recommendations"]) == 1
-            assert data["recommendations"][0]["item"] == "Mocked Recommendation"
-            assert data["recommendations"][0]["reason"] == "This is a mocked recommendation for testing"
-            assert data["recommendations"][0]["confidence"] == 85
+        assert recovered.json()["recommendations"] == [MOCK_AI_RECOMMENDATION]
+        assert len(shared_openai_client.calls) == 2
     
     @pytest.mark.asyncio
-    async def test_get_ai_recommendations_ai_api_failure(self, client: TestClient, test_customer_data: dict, test_product_data: dict, test_order_data: dict):
-        """Test getting AI recommendations when AI API fails (should fallback to rule-based)."""
-        # Create customer and product
-        create_customer_response = await client.post("/customers", json=test_customer_data)
-        customer_id = create_customer_response.json()["id"]
+    async def test_stream_ai_recommendations_ndjson(self, client: httpx.AsyncClient, seeded_ids: dict, test_order_data: Mapping, llm_settings):
+        """Test streamed recommendations arrive as newline-delimited JSON, one per line."""
+        customer_id = seeded_ids["customer_id"]
+        await client.post("/orders", json={**test_order_data, "customer_id": customer_id, "product_id": seeded_ids["product_id"]})
+        mock_ai_success(shared_openai_client)
         
-        create_product_response = await client.post("/products", json=test_product_data)
-        product_id = create_product_response.json()["id"]
+        response = await client.post(f"/customers/{customer_id}/recommendations/stream")
         
-        # Create order (purchase history)
-        order_data = test_order_data.copy()
-        order_data["customer_id"] = customer_id
-        order_data["product_id"] = product_id
-        
-        await client.post("/orders", json=order_data)
-        
-        # Mock AI API failure
-        with patch('app.services.ai_service.AsyncOpenAI') as mock_openai:
-            # Set up the mock to raise an exception
-            mock_client = AsyncMock()
-            mock_openai.return_value = mock_client
-            
-            mock_client.chat.completions.create.side_effect = Exception("AI API Error")
-            
-            # Get recommendations (should fallback to rule-based)
-            response = await client.post(f"/customers/{customer_id}/recommendations")
-            
-            assert response.status_code == 200
-            data = response.json()
-            
-            assert data["customer_id"] == customer_id
-            assert len(data["recommendations"]) > 0
-            assert data["source"] == "ai"
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/x-ndjson"
+        assert response.text.endswith("\n")
+        assert [json.loads(line) for line in response.text.splitlines()] == [MOCK_AI_RECOMMENDATION]
     
     @pytest.mark.asyncio
-    async def test_get_ai_recommendations_nonexistent_customer(self, client: TestClient):
-        """Test getting AI recommendations for non-existent customer."""
-        response = await client.post("/customers/999/recommendations")
+    async def test_stream_ai_recommendations_nonexistent_customer(self, client: httpx.AsyncClient):
+        """Test streaming recommendations for an unknown customer returns 404 before any body is sent."""
+        response = await client.post("/customers/999/recommendations/stream")
         
         assert response.status_code == 404
-        assert "Customer not found" in response.json()["detail"]
+        assert response.json()["detail"] == "Customer not found"
 
 
 class TestHealthEndpoint:
     """Test cases for health endpoint."""
     
     @pytest.mark.asyncio
-    async def test_health_check(self, client: TestClient):
+    async def test_health_check(self, client: httpx.AsyncClient):
         """Test the health check endpoint."""
         response = await client.get("/health")
         
@@ -0,0 +1,42 @@
+from unittest.mock import patch
+
+from app.core.cache import TTLCache
+
+
+class TestTTLCache:
+    """Test cases for the in-process TTL cache."""
+    
+    def test_set_and_get(self):
+        """Test a stored value is returned until it expires."""
+        cache = TTLCache(maxsize=10, ttl=60)
+        cache.set("key", {"value": 1})
+        
+        assert cache.get("key") == {"value": 1}
+        assert "key" in cache
+        assert cache.get("missing") is None
+    
+    def test_entry_expires_after_ttl(self):
+        """Test expired entries are treated as misses and dropped."""
+        cache = TTLCache(maxsize=10, ttl=60)
+        
+        with patch("app.core.cache.time.monotonic", return_value=1000.0):
+            cache.set("key", "value")
+        
+        with patch("app.core.cache.time.monotonic", return_value=1061.0):
+            assert cache.get("key") is None
+        
+        assert len(cache) == 0
+    
+    def test_evicts_least_recently_used(self):
+        """Test the least recently used entry is evicted when full."""
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        
+        # Touch "a" so "b" becomes least recently used
+        cache.get("a")
+        cache.set("c", 3)
+        
+        assert "a" in cache
+        assert "b" not in cache
+        assert "c" in cache
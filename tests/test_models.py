@@ -1,6 +1,7 @@
 import pytest
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
+from sqlalchemy.orm import joinedload, selectinload
 
 from app.models.customer import Customer
 from app.models.product import Product
@@ -46,27 +47,22 @@ class TestCustomerModel:
         with pytest.raises(Exception):  # Should raise integrity error
             await db_session.commit()
     
+    @pytest.mark.slow
     @pytest.mark.asyncio
     async def test_customer_with_orders(self, db_session: AsyncSession):
         """Test customer with related orders."""
-        # Create customer
+        # Create customer and product, flushing to populate their IDs
         customer = Customer(
             name="John Doe",
             email="john@example.com"
         )
-        db_session.add(customer)
-        await db_session.commit()
-        await db_session.refresh(customer)
-        
-        # Create product
         product = Product(
             name="Test Product",
             category="Electronics",
             price=99.99
         )
-        db_session.add(product)
-        await db_session.commit()
-        await db_session.refresh(product)
+        db_session.add_all([customer, product])
+        await db_session.flush()
         
         # Create orders
         order1 = Order(
@@ -84,14 +80,14 @@ class TestCustomerModel:
         db_session.add_all([order1, order2])
         await db_session.commit()
         
-        # Refresh customer with orders
+        # Load customer with orders in one eager query
         result = await db_session.execute(
-            select(Customer).where(Customer.id == customer.id)
+            select(Customer)
+            .options(selectinload(Customer.orders))
+            .where(Customer.id == customer.id)
         )
         customer_with_orders = result.scalar_one()
         
-        await db_session.refresh(customer_with_orders, ["orders"])
-        
         assert len(customer_with_orders.orders) == 2
         assert customer_with_orders.orders[0].quantity == 2
         assert customer_with_orders.orders[1].quantity == 1
@@ -127,24 +123,18 @@ class TestOrderModel:
     @pytest.mark.asyncio
     async def test_create_order(self, db_session: AsyncSession):
         """Test creating an order."""
-        # Create customer
+        # Create customer and product, flushing to populate their IDs
         customer = Customer(
             name="John Doe",
             email="john@example.com"
         )
-        db_session.add(customer)
-        await db_session.commit()
-        await db_session.refresh(customer)
-        
-        # Create product
         product = Product(
             name="Test Product",
             category="Electronics",
             price=99.99
         )
-        db_session.add(product)
-        await db_session.commit()
-        await db_session.refresh(product)
+        db_session.add_all([customer, product])
+        await db_session.flush()
         
         # Create order
         order = Order(
@@ -155,33 +145,28 @@ class TestOrderModel:
         
         db_session.add(order)
         await db_session.commit()
-        await db_session.refresh(order)
         
         assert order.id is not None
         assert order.customer_id == customer.id
         assert order.product_id == product.id
         assert order.quantity == 2
     
+    @pytest.mark.slow
     @pytest.mark.asyncio
     async def test_order_with_relationships(self, db_session: AsyncSession):
         """Test order with customer and product relationships."""
-        # Create customer and product
+        # Create customer and product, flushing to populate their IDs
         customer = Customer(
             name="John Doe",
             email="john@example.com"
         )
-        db_session.add(customer)
-        await db_session.commit()
-        await db_session.refresh(customer)
-        
         product = Product(
             name="Test Product",
             category="Electronics",
             price=99.99
         )
-        db_session.add(product)
-        await db_session.commit()
-        await db_session.refresh(product)
+        db_session.add_all([customer, product])
+        await db_session.flush()
         
         # Create order
         order = Order(
@@ -192,16 +177,15 @@ class TestOrderModel:
         
         db_session.add(order)
         await db_session.commit()
-        await db_session.refresh(order)
         
         # Test relationships
         result = await db_session.execute(
-            select(Order).where(Order.id == order.id)
+            select(Order)
+            .options(joinedload(Order.customer), joinedload(Order.product))
+            .where(Order.id == order.id)
         )
         order_with_relations = result.scalar_one()
         
-        await db_session.refresh(order_with_relations, ["customer", "product"])
-        
         assert order_with_relations.customer.name == "John Doe"
         assert order_with_relations.product.name == "Test Product"
         assert order_with_relations.product.category == "Electronics"
@@ -1,15 +1,60 @@
 import pytest
 import json
+import asyncio
+import httpx
+from typing import List
+from openai import BadRequestError
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
 from unittest.mock import AsyncMock, patch, MagicMock
 
+from app.core.config import settings
 from app.services.customer import create_customer, get_customer_by_id, get_customer_with_history
-from app.services.order import create_order, get_order_by_id
-from app.services.product import create_product
-from app.services.ai_service import AIService
+from app.services.order import create_order, get_all_orders, get_order_by_id, get_orders_by_customer, get_purchase_history_by_customer
+from app.services.product import _ALL_PRODUCTS_KEY, _product_cache, create_product, get_all_products, get_product_by_id
+from app.services.ai_service import AIService, RecommendationBatcher, get_llm_http_client
+from app.services.recommendation import RecommendationService, _context_cache, _context_locks, _llm_response_cache, invalidate_customer_context
+from app.models.order import Order
+from app.models.product import Product
 from app.schemas.customer import CustomerCreate
 from app.schemas.order import OrderCreate
 from app.schemas.product import ProductCreate
+from tests.conftest import (
+    MOCK_AI_RECOMMENDATION,
+    MOCK_AI_SETTINGS,
+    FakeOpenAIClient,
+    bulk_seed,
+    completion_chunks,
+    count_queries,
+    mock_ai_failure,
+    mock_ai_success,
+    sse_completion_body,
+)
+
+
+# Payloads are built once at import; tests only read them. Setup-only schemas skip
+# validation with model_construct; the service tests still validate their own inputs
+_NEIGHBOURHOOD_CUSTOMERS = (
+    CustomerCreate.model_construct(name="Target", email="target@example.com"),
+    CustomerCreate.model_construct(name="Similar", email="similar@example.com"),
+    CustomerCreate.model_construct(name="Unrelated", email="unrelated@example.com"),
+)
+_NEIGHBOURHOOD_PRODUCTS = (
+    ProductCreate.model_construct(name="Laptop", category="Electronics", price=999.0),
+    ProductCreate.model_construct(name="Earbuds", category="Electronics", price=99.0),
+    ProductCreate.model_construct(name="Novel", category="Books", price=19.0),
+)
+_PAIRS_WELL_SSE_BODY = sse_completion_body(json.dumps(
+    [{"product_id": 2, "reason": "Pairs well", "confidence_score": 80}]
+))
+_REQUIRED_REC_KEYS = frozenset({"item", "reason", "confidence"})
+_PURCHASE_HISTORY = ("Test Product (Category: Electronics)",)
+
+
+@pytest.fixture(scope="module")
+def ai_service() -> AIService:
+    """One unconfigured AIService shared by the tests that only exercise its pure helpers."""
+    return AIService()
 
 
 class TestCustomerService:
@@ -56,21 +101,9 @@ class TestCustomerService:
         assert customer is None
     
     @pytest.mark.asyncio
-    async def test_get_customer_with_history_service(self, db_session: AsyncSession):
+    async def test_get_customer_with_history_service(self, db_session: AsyncSession, seed_customer_product: tuple):
         """Test getting customer with order history via service."""
-        # Create customer and product
-        customer_data = CustomerCreate(
-            name="John Doe",
-            email="john@example.com"
-        )
-        customer = await create_customer(db_session, customer_data)
-        
-        product_data = ProductCreate(
-            name="Test Product",
-            category="Electronics",
-            price=99.99
-        )
-        product = await create_product(db_session, product_data)
+        customer, product = seed_customer_product
         
         # Create order
         order_data = OrderCreate(
@@ -80,9 +113,11 @@ class TestCustomerService:
         )
         await create_order(db_session, order_data)
         
-        # Get customer with history
-        customer_with_history = await get_customer_with_history(db_session, customer.id)
+        # Get customer with history; the customer, then one IN query for orders with products joined
+        with count_queries() as queries:
+            customer_with_history = await get_customer_with_history(db_session, customer.id)
         
+        assert len(queries) == 2
         assert customer_with_history is not None
         assert customer_with_history.id == customer.id
         assert customer_with_history.name == customer.name
@@ -95,34 +130,67 @@ class TestCustomerService:
         assert order.product.name == product.name
 
 
+class TestProductService:
+    """Test cases for product service functions."""
+    
+    @pytest.mark.asyncio
+    async def test_product_reads_are_cached_until_create(self, db_session: AsyncSession):
+        """Test product reads are served from cache and refreshed by create_product."""
+        laptop = await create_product(db_session, ProductCreate(name="Laptop", category="Electronics", price=999.0))
+        
+        assert [product.name for product in await get_all_products(db_session)] == ["Laptop"]
+        
+        # A write that bypasses the service is not visible until the cache is invalidated
+        db_session.add(Product(name="Direct", category="Books", price=5.0))
+        await db_session.commit()
+        assert len(await get_all_products(db_session)) == 1
+        
+        await create_product(db_session, ProductCreate(name="Earbuds", category="Electronics", price=99.0))
+        assert {product.name for product in await get_all_products(db_session)} == {"Laptop", "Direct", "Earbuds"}
+        
+        cached_laptop = await get_product_by_id(db_session, laptop.id)
+        assert cached_laptop.name == "Laptop"
+        assert await get_product_by_id(db_session, laptop.id) is cached_laptop
+        assert await get_product_by_id(db_session, 999) is None
+    
+    @pytest.mark.asyncio
+    async def test_get_all_products_keyset_pages(self, db_session: AsyncSession):
+        """Test the product catalogue can be paged with an id cursor."""
+        for number in range(5):
+            await create_product(db_session, ProductCreate(name=f"Product {number}", category="Books", price=10.0))
+        
+        first_page = await get_all_products(db_session, limit=3)
+        second_page = await get_all_products(db_session, limit=3, after_id=first_page[-1].id)
+        
+        assert [product.name for product in first_page + second_page] == [f"Product {number}" for number in range(5)]
+        # Pages are limited in SQL and never load the cached full catalogue
+        assert _ALL_PRODUCTS_KEY not in _product_cache
+        assert len(await get_all_products(db_session)) == 5
+
+
 class TestOrderService:
     """Test cases for order service functions."""
     
-    @pytest.mark.asyncio
-    async def test_create_order_service(self, db_session: AsyncSession):
-        """Test creating an order via service."""
-        # Create customer and product
-        customer_data = CustomerCreate(
-            name="John Doe",
-            email="john@example.com"
-        )
-        customer = await create_customer(db_session, customer_data)
+    @pytest.fixture
+    def order_factory(self, db_session: AsyncSession, seed_customer_product: tuple):
+        """Create orders for the class's seeded customer and product via the service."""
+        customer, product = seed_customer_product
         
-        product_data = ProductCreate(
-            name="Test Product",
-            category="Electronics",
-            price=99.99
-        )
-        product = await create_product(db_session, product_data)
+        async def make(quantity: int = 2) -> Order:
+            return await create_order(db_session, OrderCreate(
+                customer_id=customer.id,
+                product_id=product.id,
+                quantity=quantity
+            ))
         
-        # Create order
-        order_data = OrderCreate(
-            customer_id=customer.id,
-            product_id=product.id,
-            quantity=2
-        )
+        return make
+    
+    @pytest.mark.asyncio
+    async def test_create_order_service(self, order_factory, seed_customer_product: tuple):
+        """Test creating an order via service."""
+        customer, product = seed_customer_product
         
-        order = await create_order(db_session, order_data)
+        order = await order_factory()
         
         assert order.id is not None
         assert order.customer_id == customer.id
@@ -130,29 +198,19 @@ class TestOrderService:
         assert order.quantity == 2
     
     @pytest.mark.asyncio
-    async def test_get_order_by_id_service(self, db_session: AsyncSession):
+    async def test_create_order_unknown_customer(self, db_session: AsyncSession, seed_customer_product: tuple):
+        """Test creating an order for a missing customer violates the foreign key."""
+        _, product = seed_customer_product
+        
+        with pytest.raises(IntegrityError):
+            await create_order(db_session, OrderCreate(customer_id=999, product_id=product.id, quantity=1))
+    
+    @pytest.mark.asyncio
+    async def test_get_order_by_id_service(self, db_session: AsyncSession, order_factory, seed_customer_product: tuple):
         """Test getting order by ID via service."""
-        # Create customer and product
-        customer_data = CustomerCreate(
-            name="John Doe",
-            email="john@example.com"
-        )
-        customer = await create_customer(db_session, customer_data)
+        customer, product = seed_customer_product
         
-        product_data = ProductCreate(
-            name="Test Product",
-            category="Electronics",
-            price=99.99
-        )
-        product = await create_product(db_session, product_data)
-        
-        # Create order
-        order_data = OrderCreate(
-            customer_id=customer.id,
-            product_id=product.id,
-            quantity=2
-        )
-        created_order = await create_order(db_session, order_data)
+        created_order = await order_factory()
         
         # Get order by ID
         retrieved_order = await get_order_by_id(db_session, created_order.id)
@@ -163,95 +221,592 @@ class TestOrderService:
         assert retrieved_order.product_id == product.id
         assert retrieved_order.quantity == 2
         assert retrieved_order.product.name == product.name
+    
+    @pytest.mark.asyncio
+    async def test_get_orders_by_customer_service(self, db_session: AsyncSession, order_factory, seed_customer_product: tuple):
+        """Test orders for a customer come back with products already loaded."""
+        customer, product = seed_customer_product
+        
+        # Create two orders
+        for quantity in (1, 2):
+            await order_factory(quantity)
+        
+        # Drop identity map so products must come from the query itself
+        db_session.expunge_all()
+        
+        orders = await get_orders_by_customer(db_session, customer.id)
+        
+        assert len(orders) == 2
+        # Accessing an unloaded relationship would raise under async
+        assert all(order.product.name == product.name for order in orders)
+    
+    @pytest.mark.asyncio
+    async def test_get_orders_by_customer_keyset_pages(self, db_session: AsyncSession, seed_customer_product: tuple):
+        """Test a customer's orders can be paged with an id cursor."""
+        customer, product = seed_customer_product
+        for quantity in range(1, 6):
+            await create_order(db_session, OrderCreate.model_construct(customer_id=customer.id, product_id=product.id, quantity=quantity))
+        
+        first_page = await get_orders_by_customer(db_session, customer.id, limit=2)
+        second_page = await get_orders_by_customer(db_session, customer.id, limit=2, after_id=first_page[-1].id)
+        last_page = await get_orders_by_customer(db_session, customer.id, limit=2, after_id=second_page[-1].id)
+        
+        assert [order.quantity for order in first_page + second_page + last_page] == [1, 2, 3, 4, 5]
+        assert len(last_page) == 1
+    
+    @pytest.mark.asyncio
+    async def test_get_all_orders_streams_in_batches(self, db_session: AsyncSession, seed_customer_product: tuple):
+        """Test all orders are streamed in id order across several fetch batches."""
+        customer, product = seed_customer_product
+        for quantity in range(1, 6):
+            await create_order(db_session, OrderCreate.model_construct(customer_id=customer.id, product_id=product.id, quantity=quantity))
+        db_session.expunge_all()
+        
+        orders = [order async for order in get_all_orders(db_session, batch_size=2)]
+        
+        assert [order.quantity for order in orders] == [1, 2, 3, 4, 5]
+        assert all(order.product.name == "Test Product" for order in orders)
+    
+    @pytest.mark.asyncio
+    async def test_get_purchase_history_by_customer_service(self, db_session: AsyncSession, order_factory, seed_customer_product: tuple):
+        """Test purchase history is returned as formatted strings."""
+        customer, _ = seed_customer_product
+        await order_factory(quantity=1)
+        
+        purchase_history = await get_purchase_history_by_customer(db_session, customer.id)
+        
+        assert purchase_history == ["Test Product (Category: Electronics)"]
+        assert await get_purchase_history_by_customer(db_session, 999) == []
+
+
+class TestRecommendationService:
+    """Test cases for the collaborative recommendation service."""
+    
+    @pytest.mark.asyncio
+    async def test_get_similar_customers(self, db_session: AsyncSession):
+        """Test similar customers are ranked by purchases in shared categories."""
+        target, similar, unrelated, laptop, earbuds, novel = await bulk_seed(
+            db_session,
+            customers=_NEIGHBOURHOOD_CUSTOMERS,
+            products=_NEIGHBOURHOOD_PRODUCTS
+        )
+        
+        await bulk_seed(db_session, orders=[
+            OrderCreate.model_construct(customer_id=customer_id, product_id=product_id, quantity=1)
+            for customer_id, product_id in [
+                (target.id, laptop.id),
+                (similar.id, laptop.id),
+                (similar.id, earbuds.id),
+                (unrelated.id, novel.id),
+            ]
+        ])
+        
+        similar_customers = await RecommendationService().get_similar_customers(db_session, target.id)
+        
+        assert len(similar_customers) == 1
+        assert similar_customers[0]["customer_id"] == similar.id
+        assert similar_customers[0]["shared_purchases"] == 2
+        assert similar_customers[0]["categories"] == ["Electronics"]
+    
+    @pytest.mark.asyncio
+    async def test_get_similar_customers_purchases_counts(self, db_session: AsyncSession):
+        """Test neighbour purchases are counted per product and exclusions are honoured."""
+        first, second, laptop, earbuds, novel = await bulk_seed(
+            db_session,
+            customers=[
+                CustomerCreate(name="First", email="first@example.com"),
+                CustomerCreate(name="Second", email="second@example.com"),
+            ],
+            products=_NEIGHBOURHOOD_PRODUCTS
+        )
+        
+        await bulk_seed(db_session, orders=[
+            OrderCreate.model_construct(customer_id=customer_id, product_id=product_id, quantity=1)
+            for customer_id, product_id in [
+                (first.id, earbuds.id),
+                (first.id, earbuds.id),
+                (second.id, earbuds.id),
+                (second.id, novel.id),
+                (second.id, laptop.id),
+            ]
+        ])
+        
+        purchases = await RecommendationService().get_similar_customers_purchases(
+            db_session,
+            [{"customer_id": first.id}, {"customer_id": second.id}],
+            [laptop.id]
+        )
+        
+        assert [(rec["product_id"], rec["purchase_count"], rec["customer_count"]) for rec in purchases] == [
+            (earbuds.id, 3, 2),
+            (novel.id, 1, 1),
+        ]
+    
+    @pytest.mark.asyncio
+    async def test_collaborative_recommendations_match_two_step_lookup(self, db_session: AsyncSession):
+        """Test the combined query returns what similar customers plus their purchases would."""
+        target, similar, unrelated, laptop, earbuds, novel = await bulk_seed(
+            db_session,
+            customers=_NEIGHBOURHOOD_CUSTOMERS,
+            products=_NEIGHBOURHOOD_PRODUCTS
+        )
+        
+        # Orders are created one at a time so each gets a distinct, increasing purchase date
+        for customer_id, product_id in [
+            (target.id, laptop.id),
+            (similar.id, laptop.id),
+            (similar.id, earbuds.id),
+            (similar.id, novel.id),
+            (unrelated.id, novel.id),
+        ]:
+            await create_order(db_session, OrderCreate.model_construct(customer_id=customer_id, product_id=product_id, quantity=1))
+        
+        recommendation_service = RecommendationService()
+        similar_customers = await recommendation_service.get_similar_customers(db_session, target.id)
+        two_step = await recommendation_service.get_similar_customers_purchases(
+            db_session, similar_customers, [laptop.id]
+        )
+        combined = await recommendation_service.get_collaborative_recommendations(db_session, target.id, [laptop.id])
+        
+        assert combined == two_step
+        # Ties go to the most recently bought product
+        assert [(rec["product_id"], rec["customer_count"]) for rec in combined] == [(novel.id, 1), (earbuds.id, 1)]
+    
+    @pytest.mark.asyncio
+    async def test_get_customer_purchase_history_aggregates(self, db_session: AsyncSession):
+        """Test purchase context totals and category counts are aggregated per category."""
+        customer, laptop, earbuds, novel = await bulk_seed(
+            db_session,
+            customers=[CustomerCreate(name="Buyer", email="buyer@example.com")],
+            products=[
+                ProductCreate(name="Laptop", category="Electronics", price=100.0),
+                ProductCreate(name="Earbuds", category="Electronics", price=20.0),
+                ProductCreate(name="Novel", category="Books", price=10.0),
+            ]
+        )
+        
+        await bulk_seed(db_session, orders=[
+            OrderCreate.model_construct(customer_id=customer.id, product_id=product_id, quantity=quantity)
+            for product_id, quantity in [(laptop.id, 1), (novel.id, 3), (earbuds.id, 2)]
+        ])
+        
+        context = await RecommendationService().get_customer_purchase_history(db_session, customer.id)
+        
+        assert context["total_orders"] == 3
+        assert context["total_spent"] == pytest.approx(170.0)
+        assert context["category_preferences"] == {"Electronics": 2, "Books": 1}
+        assert context["favorite_categories"][0] == ("Electronics", 2)
+        assert {p["product_id"] for p in context["recent_purchases"]} == {laptop.id, earbuds.id, novel.id}
+        assert await RecommendationService().get_customer_purchase_history(db_session, 999) == {}
+    
+    @pytest.mark.asyncio
+    async def test_purchase_history_context_is_cached_until_invalidated(self, db_session: AsyncSession):
+        """Test the purchase-history context is reused until the customer orders again."""
+        customer, product = await bulk_seed(
+            db_session,
+            customers=[CustomerCreate(name="Buyer", email="buyer@example.com")],
+            products=[ProductCreate(name="Laptop", category="Electronics", price=100.0)]
+        )
+        await create_order(db_session, OrderCreate(customer_id=customer.id, product_id=product.id, quantity=1))
+        recommendation_service = RecommendationService()
+        
+        context = await recommendation_service.get_customer_purchase_history(db_session, customer.id)
+        assert await recommendation_service.get_customer_purchase_history(db_session, customer.id) is context
+        
+        await create_order(db_session, OrderCreate(customer_id=customer.id, product_id=product.id, quantity=1))
+        invalidate_customer_context(customer.id)
+        
+        refreshed = await recommendation_service.get_customer_purchase_history(db_session, customer.id)
+        assert refreshed["total_orders"] == 2
+    
+    @pytest.mark.asyncio
+    async def test_context_invalidated_mid_load_is_not_cached(self):
+        """Test an invalidation during a load keeps the stale context out of the cache, and queued callers share one lock."""
+        recommendation_service = RecommendationService()
+        loads: List[asyncio.Event] = []
+        
+        async def load(db, customer_id, session_factory=None):
+            # Each load blocks until the test releases it
+            gate = asyncio.Event()
+            loads.append(gate)
+            await gate.wait()
+            return {"customer_id": customer_id, "load": len(loads)}
+        
+        async def wait_for_loads(count: int) -> None:
+            while len(loads) < count:
+                await asyncio.sleep(0)
+        
+        recommendation_service._load_customer_purchase_history = load
+        first = asyncio.create_task(recommendation_service.get_customer_purchase_history(None, 42))
+        second = asyncio.create_task(recommendation_service.get_customer_purchase_history(None, 42))
+        await wait_for_loads(1)
+        
+        # An order lands while the first load is still querying
+        invalidate_customer_context(42)
+        loads[0].set()
+        assert (await first)["load"] == 1
+        assert 42 not in _context_cache
+        
+        # The queued caller reloads; a newcomer waits on the same lock instead of loading too
+        await wait_for_loads(2)
+        third = asyncio.create_task(recommendation_service.get_customer_purchase_history(None, 42))
+        await asyncio.sleep(0)
+        loads[1].set()
+        
+        assert (await second)["load"] == 2
+        assert (await third)["load"] == 2
+        assert len(loads) == 2
+        assert 42 not in _context_locks
+    
+    def test_http_client_is_the_shared_llm_pool(self):
+        """Test LLM calls go through the same pooled HTTP client as the AI service."""
+        assert RecommendationService()._get_client() is get_llm_http_client()
+    
+    @pytest.mark.asyncio
+    async def test_identical_llm_prompts_share_one_call(self):
+        """Test concurrent and repeated requests with the same prompt reuse one LLM call."""
+        _llm_response_cache.clear()
+        recommendation_service = RecommendationService()
+        recommendation_service.base_url = "http://llm.test/v1"
+        recommendation_service._configured = True
+        calls = []
+        
+        async def handler(request: httpx.Request) -> httpx.Response:
+            calls.append(request)
+            await asyncio.sleep(0.01)
+            return httpx.Response(200, text=_PAIRS_WELL_SSE_BODY)
+        
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        context = {"customer_name": "Buyer", "favorite_categories": [], "recent_purchases": []}
+        products = [{"id": 2, "name": "Earbuds", "category": "Electronics", "price": 99.0}]
+        
+        with patch.object(recommendation_service, "_get_client", return_value=client):
+            first, second = await asyncio.gather(
+                recommendation_service.generate_llm_recommendations(context, products, []),
+                recommendation_service.generate_llm_recommendations(context, products, [])
+            )
+            third = await recommendation_service.generate_llm_recommendations(context, products, [])
+        await client.aclose()
+        
+        assert len(calls) == 1
+        assert first == second == third == [{"product_id": 2, "reason": "Pairs well", "confidence_score": 80, "source": "llm"}]
+        assert recommendation_service._inflight == {}
+    
+    @pytest.mark.asyncio
+    async def test_llm_recommendations_are_parsed_while_streaming(self):
+        """Test streamed LLM output is parsed incrementally, fenced or not."""
+        _llm_response_cache.clear()
+        recommendation_service = RecommendationService()
+        recommendation_service.base_url = "http://llm.test/v1"
+        recommendation_service._configured = True
+        recommendations = [
+            {"product_id": product_id, "reason": f"Reason {product_id}", "confidence_score": 150}
+            for product_id in range(1, 8)
+        ]
+        content = f"```json\n{json.dumps(recommendations)}\n```"
+        
+        async def handler(request: httpx.Request) -> httpx.Response:
+            assert json.loads(request.content)["stream"] is True
+            return httpx.Response(200, text=sse_completion_body(content))
+        
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        context = {"customer_name": "Buyer", "favorite_categories": [], "recent_purchases": []}
+        
+        with patch.object(recommendation_service, "_get_client", return_value=client):
+            parsed = await recommendation_service.generate_llm_recommendations(context, [], [])
+        await client.aclose()
+        
+        # Reading stops once enough recommendations have arrived
+        assert [rec["product_id"] for rec in parsed] == [1, 2, 3, 4, 5]
+        assert all(rec["confidence_score"] == 100 for rec in parsed)
+    
+    @pytest.mark.asyncio
+    async def test_llm_call_retries_transient_failures(self):
+        """Test rate-limited LLM calls are retried, honouring Retry-After, and client errors are not."""
+        _llm_response_cache.clear()
+        recommendation_service = RecommendationService()
+        recommendation_service.base_url = "http://llm.test/v1"
+        recommendation_service._configured = True
+        statuses = [429, 200]
+        calls = []
+        
+        async def handler(request: httpx.Request) -> httpx.Response:
+            calls.append(request)
+            status_code = statuses[min(len(calls), len(statuses)) - 1]
+            if status_code != 200:
+                return httpx.Response(status_code, headers={"Retry-After": "0"})
+            return httpx.Response(200, text=_PAIRS_WELL_SSE_BODY)
+        
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        context = {"customer_name": "Buyer", "favorite_categories": [], "recent_purchases": []}
+        
+        with patch.object(recommendation_service, "_get_client", return_value=client):
+            recovered = await recommendation_service.generate_llm_recommendations(context, [], [])
+            assert len(calls) == 2
+            assert [rec["product_id"] for rec in recovered] == [2]
+            
+            _llm_response_cache.clear()
+            calls.clear()
+            statuses[:] = [400]
+            assert await recommendation_service.generate_llm_recommendations(context, [], []) == []
+            assert len(calls) == 1
+        await client.aclose()
+    
+    def test_rank_recommendations(self):
+        """Test sources are merged, de-duplicated and ranked by confidence."""
+        collaborative = [
+            {"product_id": 1, "product_name": "Laptop", "category": "Electronics", "price": 999.0,
+             "purchase_count": 2, "customer_count": 2},
+        ]
+        llm = [
+            {"product_id": 1, "reason": "Duplicate of collaborative", "confidence_score": 10, "source": "llm"},
+            {"product_id": 2, "reason": "Pairs well", "confidence_score": 95, "source": "llm"},
+            {"product_id": 99, "reason": "Not available", "confidence_score": 99, "source": "llm"},
+        ]
+        available = [
+            {"id": 1, "name": "Laptop", "category": "Electronics", "price": 999.0, "description": ""},
+            {"id": 2, "name": "Earbuds", "category": "Electronics", "price": 99.0, "description": ""},
+        ]
+        
+        ranked = RecommendationService().rank_recommendations(collaborative, llm, available, limit=5)
+        
+        assert [(rec["product_id"], rec["source"]) for rec in ranked] == [(2, "llm"), (1, "collaborative")]
+    
+    @pytest.mark.asyncio
+    async def test_get_similar_customers_no_history(self, db_session: AsyncSession):
+        """Test a customer without orders has no similar customers."""
+        customer = await create_customer(db_session, CustomerCreate(name="New", email="new@example.com"))
+        
+        similar_customers = await RecommendationService().get_similar_customers(db_session, customer.id)
+        
+        assert similar_customers == []
 
 
 class TestAIService:
     """Test cases for AI service."""
     
+    # CPU-only tests: requesting a database fixture here fails collection
+    pytestmark = pytest.mark.no_db
+    
+    @pytest.fixture(scope="class")
+    def configured_ai_service(self):
+        """One AIService for the class, built under LLM settings with an injected fake client."""
+        # Settings are only read at construction, so the patch need not outlive it
+        with patch.multiple(settings, **MOCK_AI_SETTINGS):
+            return AIService(FakeOpenAIClient())
+    
+    def test_ai_service_not_configured_fallback(self, ai_service: AIService):
+        """Test an unconfigured AI service falls back to rule-based recommendations without awaiting."""
+        recommendations = ai_service._get_fallback_recommendations(list(_PURCHASE_HISTORY))
+        
+        assert len(recommendations) > 0
+        assert MOCK_AI_RECOMMENDATION not in recommendations
+        assert all(_REQUIRED_REC_KEYS <= rec.keys() for rec in recommendations)
+    
+    @pytest.mark.slow
     @pytest.mark.asyncio
-    async def test_ai_service_not_configured_fallback(self):
-        """Test AI service uses fallback when not configured."""
-        # Create AI service without configuration
-        ai_service = AIService()
+    @pytest.mark.parametrize(
+        "ai_mock,expected",
+        [
+            (mock_ai_success, [MOCK_AI_RECOMMENDATION]),
+            (mock_ai_failure, None),
+        ],
+        ids=["mocked_api", "api_failure_fallback"],
+    )
+    async def test_ai_service_recommendations(self, configured_ai_service: AIService, ai_mock, expected):
+        """Test AI service output when the API answers and when it fails."""
+        ai_service = configured_ai_service
+        ai_service.client.reset()
+        ai_mock(ai_service.client)
         
-        # Mock settings to be empty
-        with patch('app.services.ai_service.settings') as mock_settings:
-            mock_settings.llm_api_key = None
-            mock_settings.llm_base_url = None
-            mock_settings.llm_model = None
-            
-            # Test with purchase history
-            purchase_history = ["Test Product (Category: Electronics)"]
-            recommendations = await ai_service.get_recommendations(purchase_history)
-            
-            # Should return fallback recommendations
+        recommendations = await ai_service.get_recommendations(list(_PURCHASE_HISTORY))
+        
+        if expected is not None:
+            # Should return AI recommendations
+            assert recommendations == expected
+        else:
+            # Should fall back to rule-based recommendations
             assert len(recommendations) > 0
-            assert all("item" in rec for rec in recommendations)
-            assert all("reason" in rec for rec in recommendations)
-            assert all("confidence" in rec for rec in recommendations)
+            assert MOCK_AI_RECOMMENDATION not in recommendations
+            assert all(_REQUIRED_REC_KEYS <= rec.keys() for rec in recommendations)
     
-    @pytest.mark.asyncio
-    async def test_ai_service_with_mocked_api(self):
-        """Test AI service with mocked API call."""
-        # Mock settings
-        with patch('app.services.ai_service.settings') as mock_settings:
-            mock_settings.llm_api_key = "test-key"
-            mock_settings.llm_base_url = "https://api.openai.com/v1"
-            mock_settings.llm_model = "gpt-3.5-turbo"
-            
-            ai_service = AIService()
+    def test_fallback_rules_match_case_insensitively(self, ai_service: AIService):
+        """Test rule-based fallback matches keywords case-insensitively in rule order."""
+        recommendations = ai_service._get_fallback_recommendations([
+            "Mastering Python (Category: Books)",
+            "AlphaSound Earbuds (Category: Electronics)"
+        ])
+        
+        # The earbuds rule precedes the programming rule in the catalogue
+        assert [rec["item"] for rec in recommendations] == [
+            "Noise-Cancelling Over-Ear Headphones",
+            "Bluetooth Fitness Smartwatch",
+            "USB-C 65W Fast Charger Adapter"
+        ]
+        
+        general = ai_service._get_fallback_recommendations(["Garden Hose (Category: Outdoors)"])
+        assert general[0]["item"] == "Premium Merino Wool V-Neck Sweater"
+    
+    def test_parse_ai_response_fenced_json(self, ai_service: AIService):
+        """Test AI responses wrapped in markdown fences are parsed."""
+        payload = json.dumps([{"item": "Fenced Product", "reason": "Fenced", "confidence": 70}])
+        
+        for content in (f"```json\n{payload}\n```", f"Here you go:\n```\n{payload}\n```", payload):
+            recommendations = ai_service._parse_ai_response(content)
             
-            # Mock the OpenAI client
-            with patch('app.services.ai_service.AsyncOpenAI') as mock_openai:
-                mock_client = AsyncMock()
-                mock_openai.return_value = mock_client
-                
-                # Mock API response
-                mock_response = AsyncMock()
-                mock_response.choices = [AsyncMock()]
-                mock_response.choices[0].message.content = json.dumps([
-                    {
-                        "item": "Mocked Product",
-                        "reason": "This is a mocked recommendation",
-                        "confidence": 85
-                    }
-                ])
-                mock_client.chat.completions.create.return_value = mock_response
-                
-                # Test with purchase history
-                purchase_history = ["Test Product (Category: Electronics)"]
-                recommendations = await ai_service.get_recommendations(purchase_history)
-                
-                # Should return AI recommendations
-                assert len(recommendations) == 1
-                assert recommendations[0]["item"] == "Mocked Product"
-                assert recommendations[0]["reason"] == "This is a mocked recommendation"
-                assert recommendations[0]["confidence"] == 85
+            assert len(recommendations) == 1
+            assert recommendations[0]["item"] == "Fenced Product"
+            assert recommendations[0]["confidence"] == 70
+    
+    def test_parse_ai_response_truncated_json(self, ai_service: AIService):
+        """Test truncated JSON falls back to text extraction."""
+        content = '```json\n[{"item": "Cut off", "reason": "Stream ended'
+        
+        assert ai_service._parse_ai_response(content) == []
+        assert ai_service._parse_ai_response("1. Desk Lamp\n2. Notebook")[1]["item"] == "Notebook"
+    
+    def test_parse_ai_response_salvages_completed_objects(self, ai_service: AIService):
+        """Test objects that closed before truncation are kept."""
+        content = '[{"item": "Kept {1}", "reason": "Said \\"done\\"", "confidence": 70}, {"item": "Lost'
+        
+        recommendations = ai_service._parse_ai_response(content)
+        
+        assert [rec["item"] for rec in recommendations] == ["Kept {1}"]
+        assert recommendations[0]["reason"] == 'Said "done"'
     
     @pytest.mark.asyncio
-    async def test_ai_service_api_failure_fallback(self):
-        """Test AI service falls back when API fails."""
-        # Mock settings
-        with patch('app.services.ai_service.settings') as mock_settings:
-            mock_settings.llm_api_key = "test-key"
-            mock_settings.llm_base_url = "https://api.openai.com/v1"
-            mock_settings.llm_model = "gpt-3.5-turbo"
-            
-            ai_service = AIService()
-            
-            # Mock the OpenAI client to raise exception
-            with patch('app.services.ai_service.AsyncOpenAI') as mock_openai:
-                mock_client = AsyncMock()
-                mock_openai.return_value = mock_client
-                
-                mock_client.chat.completions.create.side_effect = Exception("API Error")
-                
-                # Test with purchase history
-                purchase_history = ["Test Product (Category: Electronics)"]
-                recommendations = await ai_service.get_recommendations(purchase_history)
-                
-                # Should fall back to rule-based recommendations
-                assert len(recommendations) > 0
-                assert all("item" in rec for rec in recommendations)
-                assert all("reason" in rec for rec in recommendations)
-                assert all("confidence" in rec for rec in recommendations)
+    async def test_stream_recommendations_yields_incrementally(self, llm_settings):
+        """Test streamed recommendations are yielded as each object completes."""
+        fake_client = FakeOpenAIClient(completion_chunks(json.dumps([
+            {"item": "First", "reason": "One", "confidence": 90},
+            {"item": "Second", "reason": "Two", "confidence": 80}
+        ]), chunk_size=5))
+        
+        ai_service = AIService(fake_client)
+        items = [rec["item"] async for rec in ai_service.stream_recommendations(["Laptop (Category: Electronics)"])]
+        
+        assert items == ["First", "Second"]
+    
+    @pytest.mark.asyncio
+    async def test_get_recommendations_requests_structured_output(self, llm_settings):
+        """Test single-customer calls request the JSON schema and unwrap its envelope."""
+        fake_client = FakeOpenAIClient(completion_chunks(json.dumps({
+            "recommendations": [{"item": "Structured", "reason": "Schema", "confidence": 77}]
+        })))
+        
+        ai_service = AIService(fake_client)
+        recommendations = await ai_service.get_recommendations(["Laptop (Category: Electronics)"])
+        
+        response_format = fake_client.calls[-1]["response_format"]
+        assert response_format["type"] == "json_schema"
+        assert recommendations == [{"item": "Structured", "reason": "Schema", "confidence": 77}]
+    
+    @pytest.mark.asyncio
+    async def test_rejected_response_format_retries_without_it(self, llm_settings):
+        """Test a backend answering 400 to response_format still yields LLM recommendations, and is not sent it again."""
+        class SchemaRejectingClient(FakeOpenAIClient):
+            async def _create(self, **kwargs):
+                if "response_format" in kwargs:
+                    self.calls.append(kwargs)
+                    request = httpx.Request("POST", "https://api.example.com/v1/chat/completions")
+                    raise BadRequestError("response_format is not supported", response=httpx.Response(400, request=request), body=None)
+                return await super()._create(**kwargs)
+        
+        reply = [{"item": "Plain JSON", "reason": "No schema", "confidence": 66}]
+        fake_client = SchemaRejectingClient(completion_chunks(json.dumps(reply)))
+        ai_service = AIService(fake_client)
+        
+        recommendations, from_llm = await ai_service.generate_recommendations(list(_PURCHASE_HISTORY))
+        
+        assert recommendations == reply
+        assert from_llm
+        assert ["response_format" in call for call in fake_client.calls] == [True, False]
+        
+        # The rejected format is remembered, so the next call goes straight to plain text
+        await ai_service.get_recommendations(list(_PURCHASE_HISTORY))
+        assert ["response_format" in call for call in fake_client.calls] == [True, False, False]
+    
+    def test_parse_batch_response(self, ai_service: AIService):
+        """Test batched AI responses are split per customer in input order."""
+        content = json.dumps({
+            "2": [{"item": "Second", "reason": "For customer 2", "confidence": 60}],
+            "1": [{"item": "First", "reason": "For customer 1", "confidence": 90}]
+        })
+        
+        batch = ai_service._parse_batch_response(f"```json\n{content}\n```", 3)
+        
+        assert [recs[0]["item"] for recs in batch[:2]] == ["First", "Second"]
+        assert batch[2] == []
+    
+    @pytest.mark.asyncio
+    async def test_batch_recommendations_single_json_call(self, llm_settings):
+        """Test a batch is sent as one JSON-mode call with per-customer fallback."""
+        fake_client = FakeOpenAIClient(completion_chunks(json.dumps({
+            "1": [{"item": "Batched Product", "reason": "For customer 1", "confidence": 88}]
+        })))
+        
+        ai_service = AIService(fake_client)
+        batch = await ai_service.get_batch_recommendations([
+            ["Laptop (Category: Electronics)"],
+            ["Cookbook (Category: Books)"]
+        ])
+        
+        assert len(fake_client.calls) == 1
+        call_kwargs = fake_client.calls[0]
+        assert call_kwargs["response_format"] == {"type": "json_object"}
+        assert batch[0][0]["item"] == "Batched Product"
+        # Customer 2 was missing from the reply, so rule-based fallback fills in
+        assert len(batch[1]) > 0
+
+
+class TestRecommendationBatcher:
+    """Test cases for coalescing concurrent AI recommendation requests."""
+    
+    @pytest.mark.asyncio
+    async def test_concurrent_requests_share_one_batch(self):
+        """Test concurrent submissions are sent as a single batched call."""
+        ai_service = MagicMock()
+        ai_service.is_configured.return_value = True
+        ai_service.generate_batch_recommendations = AsyncMock(side_effect=lambda histories: [
+            ([{"item": f"For {history[0]}", "reason": "Batched", "confidence": 80}], True)
+            for history in histories
+        ])
+        batcher = RecommendationBatcher(ai_service, window=0.01, max_batch_size=8)
+        
+        results = await asyncio.gather(*(
+            batcher.submit([f"Product {number}"]) for number in range(3)
+        ))
+        
+        ai_service.generate_batch_recommendations.assert_awaited_once()
+        assert [(recs[0]["item"], from_llm) for recs, from_llm in results] == [
+            ("For Product 0", True), ("For Product 1", True), ("For Product 2", True)
+        ]
+    
+    @pytest.mark.asyncio
+    async def test_single_request_uses_single_call(self):
+        """Test a lone submission falls through to the single-customer call."""
+        ai_service = MagicMock()
+        ai_service.is_configured.return_value = True
+        ai_service.generate_recommendations = AsyncMock(return_value=(
+            [{"item": "Solo", "reason": "Alone in window", "confidence": 70}], True
+        ))
+        ai_service.generate_batch_recommendations = AsyncMock()
+        batcher = RecommendationBatcher(ai_service, window=0.01, max_batch_size=8)
+        
+        recommendations, from_llm = await batcher.submit(["Product"])
+        
+        assert recommendations[0]["item"] == "Solo"
+        assert from_llm
+        ai_service.generate_batch_recommendations.assert_not_awaited()
+    
+    @pytest.mark.asyncio
+    async def test_unconfigured_service_skips_batch_window(self):
+        """Test an unconfigured service answers at once instead of waiting out the window."""
+        ai_service = AIService()
+        batcher = RecommendationBatcher(ai_service, window=60.0, max_batch_size=8)
+        
+        recommendations, from_llm = await asyncio.wait_for(batcher.submit(list(_PURCHASE_HISTORY)), timeout=1.0)
+        
+        assert len(recommendations) > 0
+        assert not from_llm
+        assert batcher._flush_handle is None